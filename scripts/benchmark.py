@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+from multiprocessing import cpu_count, get_context
+
+# Benchmark harness: builds synthetic sectional charts (paletted Lambert Conformal Conic GeoTIFFs,
+# clip shapefiles and .htm metadata), runs each stage script on them and records the time,
+# throughput and peak memory of each stage to JSON, optionally checked against a stored baseline.
+#
+# A child's peak RSS includes the peak of the process that forked it, so this process stays small:
+# numpy, rasterio and geopandas are only imported by the helper process that builds and measures
+# the fixtures (see run_helper).
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Each synthetic chart covers this many degrees inside its collar, like a real sectional
+chart_span = (6.0, 4.0)
+collar = 0.4
+
+# Build the fixture set in work_dir: rawtiff/ with the charts and .htm, shapefiles/ with the clip polygons.
+# Charts are laid out side by side over the western US so neighbouring collars overlap.
+def make_fixtures(work_dir, charts=2, width=2000, seed=0):
+    import numpy as np
+    import rasterio
+    import geopandas as gpd
+    from rasterio.transform import from_bounds
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window
+    from shapely.geometry import box
+
+    raw_dir = os.path.join(work_dir, 'rawtiff')
+    shapefile_dir = os.path.join(work_dir, 'shapefiles')
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(shapefile_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    height = int(width * chart_span[1] / chart_span[0])
+    colormap = {index: ((index * 37) % 256, (index * 101) % 256, (index * 53) % 256, 255) for index in range(256)}
+
+    for chart in range(charts):
+        name = f'Synthetic{chart + 1} SEC'
+        lon_0 = -112 + chart_span[0] * (chart % 4)
+        lat_0 = 36 + chart_span[1] * (chart // 4)
+        crs = f'+proj=lcc +lat_1=33 +lat_2=45 +lat_0={lat_0} +lon_0={lon_0} +datum=NAD83 +units=m +no_defs'
+        west, east = lon_0 - chart_span[0] / 2, lon_0 + chart_span[0] / 2
+        south, north = lat_0 - chart_span[1] / 2, lat_0 + chart_span[1] / 2
+
+        # The clip polygon follows the meridians and parallels, so it is curved in the chart's projection
+        polygon = box(west, south, east, north).segmentize(0.1)
+        gpd.GeoDataFrame({'name': [name]}, geometry=[polygon], crs='EPSG:4326').to_crs(crs).to_file(os.path.join(shapefile_dir, name + '.shp'))
+
+        bounds = transform_bounds('EPSG:4326', crs, west - collar, south - collar, east + collar, north + collar)
+        transform = from_bounds(*bounds, width, height)
+        with rasterio.open(os.path.join(raw_dir, name + '.tif'), 'w', driver='GTiff', width=width, height=height, count=1,
+                           dtype='uint8', crs=crs, transform=transform, compress='lzw') as dataset:
+            # Written in strips so large fixtures don't need the whole chart in memory
+            for row in range(0, height, 512):
+                rows = min(512, height - row)
+                yy, xx = np.mgrid[row:row + rows, 0:width]
+                # Flat colour areas with sparse "text" speckle, so it compresses roughly like a chart
+                data = ((xx // 37) * 7 + (yy // 29) * 13 + chart * 17) % 200 + 1
+                speckle = rng.random((rows, width)) < 0.05
+                data[speckle] = rng.integers(200, 256, np.count_nonzero(speckle))
+                dataset.write(data.astype(np.uint8), 1, window=Window(0, row, width, rows))
+            dataset.write_colormap(1, colormap)
+
+    with open(os.path.join(raw_dir, 'Synthetic SEC.htm'), 'w') as htm_file:
+        htm_file.write(f'<html><head><meta name="dc.date" content="{datetime.now():%Y%m%d}"></head></html>')
+
+# Run a fixture function in a freshly spawned helper process, keeping its imports out of this one
+def run_helper(function, *args):
+    with get_context('spawn').Pool(1) as helper:
+        return helper.apply(function, args)
+
+# Version of GDAL the stages run with
+def gdal_version():
+    import rasterio
+    return rasterio.__gdal_version__
+
+# Make the fixtures unless the work directory already has a set built with the same parameters
+def ensure_fixtures(work_dir, params):
+    params_path = os.path.join(work_dir, 'fixtures.json')
+    if os.path.exists(params_path):
+        with open(params_path) as params_file:
+            if json.load(params_file) == params:
+                return
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    run_helper(make_fixtures, work_dir, params['charts'], params['width'], params['seed'])
+    with open(params_path, 'w') as params_file:
+        json.dump(params, params_file, indent=4)
+
+# Total pixels of the GeoTIFFs in a directory
+def count_pixels(directory):
+    import rasterio
+    pixels = 0
+    for filename in os.listdir(directory):
+        if filename.endswith('.tif'):
+            with rasterio.open(os.path.join(directory, filename)) as dataset:
+                pixels += dataset.width * dataset.height
+    return pixels
+
+# Number of tiles written for a zoom level
+def count_tiles(tiles_dir, zoom_level):
+    zoom_dir = os.path.join(tiles_dir, str(zoom_level))
+    if not os.path.isdir(zoom_dir):
+        return 0
+    return sum(len([filename for filename in files if filename.endswith(('.png', '.webp', '.jpg'))]) for _, _, files in os.walk(zoom_dir))
+
+# Run a stage script in the work directory. Returns the wall time in seconds and the peak RSS in MB of
+# the largest process it ran (its pool workers included), or None where wait4 isn't available.
+def run_script(work_dir, script, args):
+    command = [sys.executable, os.path.join(scripts_dir, script)] + args
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        peak_rss_mb = usage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    else:
+        process.wait()
+        seconds = time.perf_counter() - started
+        peak_rss_mb = None
+    if process.returncode != 0:
+        raise RuntimeError(f'{script} failed with exit code {process.returncode}')
+    return seconds, peak_rss_mb
+
+# Run a stage repeat times, keeping the fastest run and the highest peak RSS
+def time_stage(work_dir, script, args, repeat, prepare=None):
+    best, peak = None, None
+    for _ in range(repeat):
+        if prepare:
+            prepare()
+        seconds, peak_rss_mb = run_script(work_dir, script, args)
+        best = seconds if best is None else min(best, seconds)
+        if peak_rss_mb is not None:
+            peak = peak_rss_mb if peak is None else max(peak, peak_rss_mb)
+    return {'seconds': round(best, 3), 'peak_rss_mb': round(peak, 1) if peak is not None else None}
+
+# Clears an output directory before a timed run
+def clean(work_dir, directory):
+    return lambda: shutil.rmtree(os.path.join(work_dir, directory), ignore_errors=True)
+
+# Time every stage on the fixtures: extract, reproject, tiles for each zoom level, and the whole chain
+def run_benchmarks(work_dir, start_zoom, end_zoom, repeat, tile_args):
+    stages = {}
+    raw_pixels = run_helper(count_pixels, os.path.join(work_dir, 'rawtiff'))
+
+    stage = time_stage(work_dir, 'extract_sectional_charts.py', ['--source_dir', './rawtiff', '--target_dir', './clipped', '--force'], repeat, clean(work_dir, 'clipped'))
+    stage['mpixels_per_s'] = round(raw_pixels / 1e6 / stage['seconds'], 2)
+    stages['extract'] = stage
+    print(f"extract: {stage['seconds']}s")
+
+    clipped_pixels = run_helper(count_pixels, os.path.join(work_dir, 'clipped'))
+    stage = time_stage(work_dir, 'reproject_tif.py', ['--input_dir', './clipped', '--output_dir', './reprojected', '--force'], repeat, clean(work_dir, 'reprojected'))
+    stage['mpixels_per_s'] = round(clipped_pixels / 1e6 / stage['seconds'], 2)
+    stages['reproject'] = stage
+    print(f"reproject: {stage['seconds']}s")
+
+    for zoom_level in range(start_zoom, end_zoom + 1):
+        args = ['--input_dir', './reprojected', '--output_dir', './tiles', '--start_zoom', str(zoom_level), '--end_zoom', str(zoom_level), '--force'] + tile_args
+        stage = time_stage(work_dir, 'make_slippy_tile.py', args, repeat, clean(work_dir, 'tiles'))
+        tiles = count_tiles(os.path.join(work_dir, 'tiles'), zoom_level)
+        stage.update({'tiles': tiles, 'tiles_per_s': round(tiles / stage['seconds'], 2)})
+        stages[f'tile_z{zoom_level}'] = stage
+        print(f"tile z{zoom_level}: {stage['seconds']}s, {tiles} tiles")
+
+    # The whole chain, each script after the other as a user would run them
+    best, peak = None, None
+    for _ in range(repeat):
+        for directory in ['clipped', 'reprojected', 'tiles']:
+            clean(work_dir, directory)()
+        seconds, peak_rss_mb = 0, None
+        for script, args in [
+            ('extract_sectional_charts.py', ['--source_dir', './rawtiff', '--target_dir', './clipped']),
+            ('reproject_tif.py', ['--input_dir', './clipped', '--output_dir', './reprojected']),
+            ('make_slippy_tile.py', ['--input_dir', './reprojected', '--output_dir', './tiles', '--start_zoom', str(start_zoom), '--end_zoom', str(end_zoom)] + tile_args),
+        ]:
+            step_seconds, step_rss = run_script(work_dir, script, args)
+            seconds += step_seconds
+            if step_rss is not None:
+                peak_rss_mb = step_rss if peak_rss_mb is None else max(peak_rss_mb, step_rss)
+        best = seconds if best is None else min(best, seconds)
+        if peak_rss_mb is not None:
+            peak = peak_rss_mb if peak is None else max(peak, peak_rss_mb)
+    tiles = sum(count_tiles(os.path.join(work_dir, 'tiles'), zoom_level) for zoom_level in range(start_zoom, end_zoom + 1))
+    stages['end_to_end'] = {'seconds': round(best, 3), 'peak_rss_mb': round(peak, 1) if peak is not None else None,
+                            'tiles': tiles, 'tiles_per_s': round(tiles / best, 2)}
+    print(f"end to end: {stages['end_to_end']['seconds']}s")
+
+    # The fused pipeline straight from the raw charts
+    args = ['--source_dir', './rawtiff', '--output_dir', './tiles_fused', '--start_zoom', str(start_zoom), '--end_zoom', str(end_zoom), '--force'] + tile_args
+    stage = time_stage(work_dir, 'make_tiles_from_raw.py', args, repeat, clean(work_dir, 'tiles_fused'))
+    tiles = sum(count_tiles(os.path.join(work_dir, 'tiles_fused'), zoom_level) for zoom_level in range(start_zoom, end_zoom + 1))
+    stage.update({'tiles': tiles, 'tiles_per_s': round(tiles / stage['seconds'], 2)})
+    stages['fused'] = stage
+    print(f"fused: {stage['seconds']}s")
+    return stages
+
+# Compare stage times with a baseline, returns the stages that got slower than the tolerance allows
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    print(f"{'stage':<14}{'baseline s':>12}{'current s':>12}{'change':>10}")
+    for name, stage in results['stages'].items():
+        baseline_stage = baseline.get('stages', {}).get(name)
+        if not baseline_stage:
+            print(f"{name:<14}{'-':>12}{stage['seconds']:>12}{'new':>10}")
+            continue
+        change = stage['seconds'] / baseline_stage['seconds'] - 1
+        flag = ' REGRESSION' if change > tolerance else ''
+        print(f"{name:<14}{baseline_stage['seconds']:>12}{stage['seconds']:>12}{change:>+10.1%}{flag}")
+        if change > tolerance:
+            regressions.append(name)
+    if baseline.get('fixtures') != results['fixtures']:
+        print('Warning: the baseline was recorded with different fixtures')
+    return regressions
+
+def main():
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description='Benchmark the chart processing scripts on synthetic sectional charts.')
+    parser.add_argument('--work_dir', type=str, default='./benchmark', help='Directory for the fixtures and stage outputs (default: ./benchmark)')
+    parser.add_argument('--charts', type=int, default=2, help='Number of synthetic charts (default: 2)')
+    parser.add_argument('--width', type=int, default=2000, help='Width of each synthetic chart in pixels (default: 2000)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the fixtures (default: 0)')
+    parser.add_argument('--start_zoom', type=int, default=7, help='Start zoom level (default: 7)')
+    parser.add_argument('--end_zoom', type=int, default=9, help='End zoom level (default: 9)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per stage, the fastest is kept (default: 1)')
+    parser.add_argument('--tile_args', type=str, default='', help='Extra options for the tile stages, e.g. "--metatile 8"')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Results file (default: benchmark.json)')
+    parser.add_argument('--baseline', type=str, help='Baseline results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown allowed before a stage counts as a regression (default: 0.1)')
+    parser.add_argument('--save_baseline', action='store_true', help='Also write the results to the --baseline file')
+    args = parser.parse_args()
+
+    fixtures = {'charts': args.charts, 'width': args.width, 'seed': args.seed}
+    work_dir = os.path.abspath(args.work_dir)
+    ensure_fixtures(work_dir, fixtures)
+
+    results = {
+        'fixtures': fixtures,
+        'zoom_levels': [args.start_zoom, args.end_zoom],
+        'tile_args': args.tile_args,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': cpu_count(), 'gdal': run_helper(gdal_version)},
+        'recorded': datetime.now().isoformat(timespec='seconds'),
+        'stages': run_benchmarks(work_dir, args.start_zoom, args.end_zoom, args.repeat, shlex.split(args.tile_args)),
+    }
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+    print(f'Results written to {args.output}')
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print(f'Baseline written to {args.baseline}')
+    elif args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
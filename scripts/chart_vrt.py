@@ -0,0 +1,123 @@
+import rasterio
+import geopandas as gpd
+from rasterio.vrt import WarpedVRT
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.features import geometry_window
+from rasterio.windows import Window
+from shapely.ops import unary_union
+from shapely.affinity import affine_transform
+from xml.sax.saxutils import escape
+
+# Virtual versions of the extract step for the fused pipeline: a raw chart is palette-expanded,
+# cropped and clipped to its shapefile polygon by GDAL as it is read or warped, so no clipped
+# GeoTIFF is ever written.
+
+# A warped VRT that also closes the dataset it reads from
+class ClippedChart(WarpedVRT):
+    def close(self):
+        super().close()
+        self.src_dataset.close()
+
+# VRT XML for a window of a chart (all of it by default). A paletted band is expanded to RGBA
+# through its colormap, the virtual equivalent of apply_colormap in extract_sectional_charts, with
+# pixels of the nodata index transparent; with keep_palette the bands are passed through as they are.
+def chart_window_vrt(dataset, window=None, keep_palette=False, nodata_value=0):
+    if window is None:
+        window = Window(0, 0, dataset.width, dataset.height)
+    col_off, row_off, width, height = (int(value) for value in (window.col_off, window.row_off, window.width, window.height))
+    source = f'<SourceFilename relativeToVRT="0">{escape(dataset.name)}</SourceFilename>'
+    rects = (f'<SrcRect xOff="{col_off}" yOff="{row_off}" xSize="{width}" ySize="{height}"/>'
+             f'<DstRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>')
+
+    bands = []
+    if dataset.colorinterp[0] == ColorInterp.palette and not keep_palette:
+        for component, color_interp in enumerate(['Red', 'Green', 'Blue', 'Alpha'], start=1):
+            bands.append(
+                f'<VRTRasterBand dataType="Byte" band="{component}">'
+                f'<ColorInterp>{color_interp}</ColorInterp>'
+                f'<ComplexSource>{source}<SourceBand>1</SourceBand>{rects}'
+                f'<NODATA>{nodata_value}</NODATA>'
+                f'<ColorTableComponent>{component}</ColorTableComponent>'
+                f'</ComplexSource>'
+                f'</VRTRasterBand>'
+            )
+    else:
+        for band, (dtype, color_interp) in enumerate(zip(dataset.dtypes, dataset.colorinterp), start=1):
+            color_table = ''
+            if color_interp == ColorInterp.palette:
+                colormap = dataset.colormap(band)
+                entries = [colormap.get(index, (0, 0, 0, 0)) for index in range(max(colormap) + 1)]
+                color_table = ('<ColorTable>'
+                               + ''.join(f'<Entry c1="{red}" c2="{green}" c3="{blue}" c4="{alpha}"/>' for red, green, blue, alpha in entries)
+                               + '</ColorTable>')
+            bands.append(
+                f'<VRTRasterBand dataType="{typename_fwd[dtype_rev[dtype]]}" band="{band}">'
+                f'<ColorInterp>{color_interp.name.capitalize()}</ColorInterp>'
+                f'{color_table}'
+                f'<SimpleSource>{source}<SourceBand>{band}</SourceBand>{rects}</SimpleSource>'
+                f'</VRTRasterBand>'
+            )
+
+    return (f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+            f'<SRS>{escape(dataset.crs.to_wkt())}</SRS>'
+            f'<GeoTransform>{", ".join(str(value) for value in dataset.window_transform(window).to_gdal())}</GeoTransform>'
+            f'{"".join(bands)}'
+            f'</VRTDataset>')
+
+# Load the clip polygon of a chart in the chart's CRS
+def clip_polygon(dataset, shapefile_path):
+    shapes = gpd.read_file(shapefile_path)
+    if shapes.crs != dataset.crs:
+        shapes = shapes.to_crs(dataset.crs)
+    return unary_union(list(shapes.geometry))
+
+# A polygon in the pixel coordinates of a dataset, which is how GDAL wants a CUTLINE
+def pixel_cutline(dataset, polygon):
+    inverse = ~dataset.transform
+    return affine_transform(polygon, [inverse.a, inverse.b, inverse.d, inverse.e, inverse.xoff, inverse.yoff]).wkt
+
+# Open a raw chart clipped and cropped to its shapefile polygon, like process_geotiff does.
+# Paletted charts are expanded to RGBA unless keep_palette is set.
+def open_clipped_chart(raster_path, shapefile_path, keep_palette=False, nodata_value=0):
+    src = rasterio.open(raster_path)
+    try:
+        polygon = clip_polygon(src, shapefile_path)
+        crop_window = geometry_window(src, [polygon])
+        crop_transform = src.window_transform(crop_window)
+        cutline = pixel_cutline(src, polygon)
+
+        src_nodata = nodata_value
+        if src.colorinterp[0] == ColorInterp.palette and not keep_palette:
+            expanded = rasterio.open(chart_window_vrt(src, nodata_value=nodata_value))
+            src.close()
+            src = expanded
+            # Transparency comes from the alpha band of the expansion
+            src_nodata = None
+    except Exception:
+        src.close()
+        raise
+
+    return ClippedChart(
+        src,
+        crs=src.crs,
+        transform=crop_transform,
+        width=int(crop_window.width),
+        height=int(crop_window.height),
+        src_nodata=src_nodata,
+        nodata=nodata_value,
+        resampling=Resampling.nearest,
+        CUTLINE=cutline
+    )
+
+# Open a raw chart to warp tiles from directly: the chart cropped to its shapefile polygon by a plain
+# VRT (and palette-expanded unless keep_palette is set), plus the warp options that clip it to the
+# polygon. The clipped chart above warps every block it serves, and a tile warp reading from it
+# warps them a second time, so tile warps apply the cutline themselves. Pixels outside the polygon,
+# and zero samples as in the clipped chart, count as nodata; the result is the same as warping the
+# clipped chart.
+def open_raw_chart(raster_path, shapefile_path, keep_palette=False, nodata_value=0):
+    with rasterio.open(raster_path) as src:
+        polygon = clip_polygon(src, shapefile_path)
+        dataset = rasterio.open(chart_window_vrt(src, geometry_window(src, [polygon]), keep_palette, nodata_value))
+    return dataset, {'src_nodata': nodata_value, 'CUTLINE': pixel_cutline(dataset, polygon)}
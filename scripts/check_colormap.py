@@ -0,0 +1,62 @@
+import os
+import sys
+import glob
+import argparse
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from extract_sectional_charts import colormap_to_lut, apply_colormap, apply_colormap_per_pixel
+
+# Check that the lookup table palette expansion of extract_sectional_charts.py is byte-identical to
+# the original per-pixel expansion on real charts: for every entry of each chart's palette, and for
+# a window of pixels from the centre of the chart. Exits with status 1 if anything differs.
+
+# Number of pixels where the two expansions of an index image differ
+def count_differences(image, colormap, lut):
+    expected = apply_colormap_per_pixel(image, colormap)
+    return int(np.any(apply_colormap(image, colormap, lut) != expected, axis=-1).sum())
+
+# Compare the expansions on a chart's palette and centre window. Returns the differing palette
+# entries and window pixels, or None if the chart isn't paletted.
+def check_chart(path, window_size):
+    with rasterio.open(path) as src:
+        if src.colorinterp[0] != rasterio.enums.ColorInterp.palette:
+            return None
+        colormap = src.colormap(1)
+        width, height = min(window_size, src.width), min(window_size, src.height)
+        window = Window((src.width - width) // 2, (src.height - height) // 2, width, height)
+        sample = src.read(1, window=window)
+    lut = colormap_to_lut(colormap)
+    palette = np.array(sorted(colormap), dtype=sample.dtype).reshape(1, -1)
+    return count_differences(palette, colormap, lut), count_differences(sample, colormap, lut)
+
+def main():
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description='Check the lookup table palette expansion against the per-pixel expansion on real charts.')
+    parser.add_argument('charts', nargs='*', help='GeoTIFF files to check (default: every .tif in --source_dir)')
+    parser.add_argument('--source_dir', type=str, default='./rawtiff', help='Directory containing the raw GeoTIFF files (default: ./rawtiff)')
+    parser.add_argument('--window_size', type=int, default=512, help='Size of the window of pixels compared at the centre of each chart (default: 512)')
+    args = parser.parse_args()
+
+    chart_paths = args.charts or sorted(glob.glob(os.path.join(args.source_dir, '*.tif')))
+    checked = 0
+    failed = False
+    for chart_path in chart_paths:
+        result = check_chart(chart_path, args.window_size)
+        name = os.path.basename(chart_path)
+        if result is None:
+            print(f'{name}: not paletted, skipped')
+            continue
+        checked += 1
+        palette_differences, window_differences = result
+        failed = failed or palette_differences > 0 or window_differences > 0
+        print(f"{name}: {'identical' if not palette_differences and not window_differences else 'DIFFERENT'} "
+              f'({palette_differences} palette entries and {window_differences} window pixels differ)')
+
+    if not checked:
+        print('No paletted charts found.')
+        sys.exit(1)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,27 @@
 import os
 import rasterio
 from rasterio.mask import mask
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
 from shapely.geometry import box
 import geopandas as gpd
 import numpy as np
 import logging
 from tqdm import tqdm
-import json
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
 from colorama import Fore, Style, init
 import argparse
 import multiprocessing
 import portalocker
+from manifest import load_metadata, save_metadata, stage_manifest, file_fingerprint, is_up_to_date
+from scheduler import run_scheduled, memory_budget, format_mb, size_estimate, process_overhead
+from instrument import RunReport
+import instrument
 
 # Author: Hal Hawkins harold.hawkins@truweathersolutions.com
 
-# Setup logging
-logging.basicConfig(filename='processing.log', level=logging.INFO, 
-                    format='%(asctime)s %(levelname)s:%(message)s')
-
 # Initialize colorama
 init()
 
@@ -48,10 +50,11 @@ def get_latest_date_from_html(directory):
         return latest_file, latest_date
     return None, None
 
-def process_geotiff(raster_path, shapefile_path, output_path, nodata_value=0):
+def process_geotiff(raster_path, shapefile_path, output_path, nodata_value=0, keep_palette=False, verify_colormap=False):
     try:
         # Load the shapefile
-        shapes = gpd.read_file(shapefile_path)
+        with instrument.phase('read_shapefile'):
+            shapes = gpd.read_file(shapefile_path)
         shapefile_crs = shapes.crs
 
         with rasterio.open(raster_path) as src:
@@ -64,15 +67,36 @@ def process_geotiff(raster_path, shapefile_path, output_path, nodata_value=0):
             geometry = [shape['geometry'] for shape in shapes.__geo_interface__['features']]
 
             # Clip the raster using the geometry
-            out_img, out_transform = mask(src, shapes=geometry, crop=True, nodata=nodata_value)
+            with instrument.phase('clip'):
+                out_img, out_transform = mask(src, shapes=geometry, crop=True, nodata=nodata_value)
             
+            # Keep paletted charts as a single indexed band with their colormap
+            if keep_palette and src.colorinterp[0] == rasterio.enums.ColorInterp.palette:
+                out_meta = src.meta.copy()
+                out_meta.update({
+                    "driver": "GTiff",
+                    "height": out_img.shape[1],
+                    "width": out_img.shape[2],
+                    "count": 1,
+                    "transform": out_transform,
+                    "compress": src.tags(ns='IMAGE_STRUCTURE').get('COMPRESSION', 'LZW'),  # Use same compression as input or default to LZW
+                    "nodata": nodata_value
+                })
+
+                with instrument.phase('write'), rasterio.open(output_path, 'w', **out_meta) as dest:
+                    dest.write(out_img[:1])
+                    dest.write_colormap(1, src.colormap(1))
             # Apply colormap if present
-            if src.colorinterp[0] == rasterio.enums.ColorInterp.palette:
-                colormap = src.colormap(1)
-                out_img_rgb = apply_colormap(out_img[0], colormap)  # out_img[0] as out_img is 3D array
+            elif src.colorinterp[0] == rasterio.enums.ColorInterp.palette:
+                with instrument.phase('colormap'):
+                    colormap = src.colormap(1)
+                    lut = colormap_to_lut(colormap)
+                    if verify_colormap and not check_colormap_identical(out_img[0], colormap, lut):
+                        raise ValueError('Vectorized colormap output differs from the per-pixel colormap output')
+                    out_img_rgb = apply_colormap(out_img[0], colormap, lut)  # out_img[0] as out_img is 3D array
 
-                # Ensure nodata value is applied
-                out_img_rgb[out_img[0] == nodata_value] = [0, 0, 0, 0]  # Set RGBA to transparent
+                    # Ensure nodata value is applied
+                    out_img_rgb[out_img[0] == nodata_value] = [0, 0, 0, 0]  # Set RGBA to transparent
                 
                 # Update metadata for the new clipped raster
                 out_meta = src.meta.copy()
@@ -88,7 +112,7 @@ def process_geotiff(raster_path, shapefile_path, output_path, nodata_value=0):
                 })
                 
                 # Save the clipped raster to a new file
-                with rasterio.open(output_path, 'w', **out_meta) as dest:
+                with instrument.phase('write'), rasterio.open(output_path, 'w', **out_meta) as dest:
                     dest.write(out_img_rgb.transpose(2, 0, 1))  # Write as (bands, rows, cols)
             else:
                 # Ensure nodata value is applied
@@ -108,14 +132,125 @@ def process_geotiff(raster_path, shapefile_path, output_path, nodata_value=0):
                 })
                 
                 # Save the clipped raster to a new file
-                with rasterio.open(output_path, 'w', **out_meta) as dest:
+                with instrument.phase('write'), rasterio.open(output_path, 'w', **out_meta) as dest:
                     dest.write(out_img)
         logging.info(f'Successfully processed: {raster_path}')
+        return True
     except Exception as e:
         logging.error(f'Error processing {raster_path}: {e}')
+        return False
+
+# Function to rasterize the clip polygon once for the whole cropped window, one strip of rows at a time.
+# The mask is stored bit-packed (True = outside the polygon) so it costs 1/8 of a byte per pixel.
+def rasterize_clip_mask(geometry, height, width, transform, block_size=1024):
+    packed_mask = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+    for row in range(0, height, block_size):
+        rows = min(block_size, height - row)
+        strip_transform = window_transform(Window(0, row, width, rows), transform)
+        strip_mask = geometry_mask(geometry, out_shape=(rows, width), transform=strip_transform)
+        packed_mask[row:row + rows] = np.packbits(strip_mask, axis=1)
+    return packed_mask
+
+# Streaming version of process_geotiff: reads, masks, palette-expands and writes the clipped
+# chart block by block so peak memory depends on block_size rather than the chart size
+def process_geotiff_windowed(raster_path, shapefile_path, output_path, nodata_value=0, keep_palette=False, verify_colormap=False, block_size=1024):
+    try:
+        # Load the shapefile
+        with instrument.phase('read_shapefile'):
+            shapes = gpd.read_file(shapefile_path)
+        shapefile_crs = shapes.crs
+
+        with rasterio.open(raster_path) as src:
+            # Reproject shapefile to raster CRS if they don't match
+            if shapefile_crs != src.crs:
+                shapes = shapes.to_crs(src.crs)
+
+            # Extract geometry in GeoJSON format
+            geometry = [shape['geometry'] for shape in shapes.__geo_interface__['features']]
+
+            # Same crop window and transform as mask(..., crop=True)
+            crop_window = geometry_window(src, geometry)
+            out_transform = src.window_transform(crop_window)
+            height, width = int(crop_window.height), int(crop_window.width)
+            with instrument.phase('rasterize_mask'):
+                packed_mask = rasterize_clip_mask(geometry, height, width, out_transform, block_size)
+
+            paletted = src.colorinterp[0] == rasterio.enums.ColorInterp.palette
+            expand_palette = paletted and not keep_palette
+            if paletted:
+                colormap = src.colormap(1)
+                lut = colormap_to_lut(colormap)
+            count = 4 if expand_palette else (1 if paletted else src.count)
+
+            out_meta = src.meta.copy()
+            out_meta.update({
+                "driver": "GTiff",
+                "height": height,
+                "width": width,
+                "count": count,
+                "dtype": 'uint8' if expand_palette else src.meta['dtype'],
+                "transform": out_transform,
+                "tiled": True,
+                "blockxsize": 256,
+                "blockysize": 256,
+                "compress": src.tags(ns='IMAGE_STRUCTURE').get('COMPRESSION', 'LZW'),  # Use same compression as input or default to LZW
+                "nodata": nodata_value
+            })
+
+            with rasterio.open(output_path, 'w', **out_meta) as dest:
+                if paletted and keep_palette:
+                    dest.write_colormap(1, colormap)
+
+                # --verify_colormap checks the block at the centre of the crop window, which is
+                # inside the chart; the corner blocks are mostly nodata
+                verify_row = height // 2 // block_size * block_size
+                verify_col = width // 2 // block_size * block_size
+                for row in range(0, height, block_size):
+                    # Unpack the clip mask once for the whole strip of rows
+                    with instrument.phase('mask'):
+                        strip_outside = np.unpackbits(packed_mask[row:row + block_size], axis=1, count=width).astype(bool)
+                    for col in range(0, width, block_size):
+                        block = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                        src_block = Window(crop_window.col_off + col, crop_window.row_off + row, block.width, block.height)
+                        indexes = [1] if paletted else None
+                        with instrument.phase('read'):
+                            block_img = src.read(indexes, window=src_block, masked=True)
+                        with instrument.phase('mask'):
+                            block_img.mask = block_img.mask | strip_outside[:, col:col + block.width]
+                            block_img = block_img.filled(nodata_value)
+
+                        if expand_palette:
+                            with instrument.phase('colormap'):
+                                if verify_colormap and (row, col) == (verify_row, verify_col) and not check_colormap_identical(block_img[0], colormap, lut):
+                                    raise ValueError('Vectorized colormap output differs from the per-pixel colormap output')
+                                block_rgb = apply_colormap(block_img[0], colormap, lut)
+                                block_rgb[block_img[0] == nodata_value] = [0, 0, 0, 0]  # Set RGBA to transparent
+                            with instrument.phase('write'):
+                                dest.write(block_rgb.transpose(2, 0, 1), window=block)
+                        else:
+                            with instrument.phase('write'):
+                                dest.write(block_img, window=block)
+        logging.info(f'Successfully processed: {raster_path}')
+        return True
+    except Exception as e:
+        logging.error(f'Error processing {raster_path}: {e}')
+        return False
+
+# Function to turn a rasterio colormap into a (N, 4) RGBA lookup table
+def colormap_to_lut(colormap):
+    lut = np.zeros((max(256, max(colormap) + 1), 4), dtype=np.uint8)
+    for index, rgba in colormap.items():
+        lut[index] = rgba
+    return lut
 
 # Function to apply a colormap to a single-band image
-def apply_colormap(image, colormap):
+def apply_colormap(image, colormap, lut=None):
+    if lut is None:
+        lut = colormap_to_lut(colormap)
+    return lut[image]  # (rows, cols) indices -> (rows, cols, 4) RGBA in one step
+
+# Original per-pixel colormap expansion, kept as the reference for check_colormap_identical
+def apply_colormap_per_pixel(image, colormap):
     height, width = image.shape
     rgba_image = np.zeros((height, width, 4), dtype=np.uint8)  # RGBA image
     for i in range(height):
@@ -124,26 +259,95 @@ def apply_colormap(image, colormap):
             rgba_image[i, j] = rgba  # Include alpha channel
     return rgba_image
 
+# Check that the lookup table output is byte-identical to the per-pixel output.
+# The per-pixel path is far too slow for a whole chart, so only a centre window is compared.
+def check_colormap_identical(image, colormap, lut=None, sample_size=512):
+    height, width = image.shape
+    row = max(0, (height - sample_size) // 2)
+    col = max(0, (width - sample_size) // 2)
+    sample = image[row:row + sample_size, col:col + sample_size]
+    identical = apply_colormap(sample, colormap, lut).tobytes() == apply_colormap_per_pixel(sample, colormap).tobytes()
+    if not identical:
+        logging.error(f'Colormap lookup table output differs from per-pixel output in window at row {row}, col {col}')
+    return identical
+
+# Clip one chart to a temporary file and rename it into place, so an interrupted run never leaves a
+# truncated chart behind. Returns whether it was processed successfully.
+def clip_chart(raster_path, shapefile_path, output_path, options):
+    temp_path = f'{output_path}.{os.getpid()}.tmp'
+    if options.get('block_size'):
+        succeeded = process_geotiff_windowed(raster_path, shapefile_path, temp_path, **options)
+    else:
+        succeeded = process_geotiff(raster_path, shapefile_path, temp_path, **options)
+    if succeeded:
+        os.replace(temp_path, output_path)
+    elif os.path.exists(temp_path):
+        os.remove(temp_path)
+    return succeeded
+
+# Estimate the peak memory of clipping a chart from its header. The in-memory path holds the masked
+# raster (data, mask and the filled copy) and, for a paletted chart expanded to RGBA, the RGBA array,
+# its transposed copy and the nodata test. The windowed path holds the bit-packed clip mask and a
+# few blocks. The crop window isn't known yet, so the whole raster is counted.
+def estimate_working_set(raster_path, options):
+    try:
+        with rasterio.open(raster_path) as src:
+            pixels = src.width * src.height
+            count = src.count
+            band_bytes = count * np.dtype(src.dtypes[0]).itemsize
+            expanded = src.colorinterp[0] == rasterio.enums.ColorInterp.palette and not options.get('keep_palette')
+    except Exception as e:
+        logging.warning(f'Could not read {raster_path} to estimate its memory use, guessing from its size: {e}')
+        return size_estimate(raster_path)
+    if options.get('block_size'):
+        block_pixels = min(options['block_size'] ** 2, pixels)
+        return process_overhead + pixels // 8 + block_pixels * (3 * band_bytes + (9 if expanded else 0))
+    return process_overhead + pixels * (2 * band_bytes + count + (9 if expanded else 0))
+
+# Returns the raster path, whether it was processed successfully and its instrumentation record.
+# Each chart is in the work list once, so it is only locked when lock_path is given for runs that
+# share the target directory with other runs.
 def process_file(file_info):
-    raster_path, shapefile_path, output_path, lock_path = file_info
-
-    with open(lock_path, 'w') as lock_file:
-        try:
-            # Acquire file lock
-            portalocker.lock(lock_file, portalocker.LOCK_EX)
-            process_geotiff(raster_path, shapefile_path, output_path)
-        except Exception as e:
-            logging.error(f'Error processing {raster_path}: {e}')
-        finally:
-            # Release file lock
-            portalocker.unlock(lock_file)
+    raster_path, shapefile_path, output_path, lock_path, options = file_info
+
+    instrument.start_item()
+    succeeded = False
+    if lock_path is None:
+        succeeded = clip_chart(raster_path, shapefile_path, output_path, options)
+    else:
+        with open(lock_path, 'w') as lock_file:
+            try:
+                # Acquire file lock
+                portalocker.lock(lock_file, portalocker.LOCK_EX)
+                succeeded = clip_chart(raster_path, shapefile_path, output_path, options)
+            except Exception as e:
+                logging.error(f'Error processing {raster_path}: {e}')
+            finally:
+                # Release file lock
+                portalocker.unlock(lock_file)
+    if succeeded:
+        instrument.count('bytes_written', os.path.getsize(output_path))
+    return raster_path, succeeded, instrument.finish_item(os.path.basename(raster_path))
 
 def main():
+    # Setup logging
+    logging.basicConfig(filename='processing.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
     # Argument parser setup
     parser = argparse.ArgumentParser(description='Extract and process sectional charts from GeoTIFF files.')
     parser.add_argument('--source_dir', type=str, default='./rawtiff', help='Source directory containing GeoTIFF files (default: ./rawtiff)')
     parser.add_argument('--target_dir', type=str, default='./clipped', help='Target directory for processed files (default: ./clipped)')
-    parser.add_argument('--num_processes', type=int, default=4, help='Number of processes to use (default: 4)')
+    parser.add_argument('--num_processes', type=int, default=multiprocessing.cpu_count(), help='Most charts processed at once (default: number of CPUs)')
+    parser.add_argument('--memory_budget_mb', type=int, default=0, help='Memory the charts being processed at once may use together, from estimates of each chart (default: 75%% of the available memory)')
+    parser.add_argument('--retries', type=int, default=2, help='Times a failed chart is retried, each time with half as many processes (default: 2)')
+    parser.add_argument('--keep_palette', action='store_true', help='Write paletted charts as a single indexed band with their colormap instead of expanding to RGBA')
+    parser.add_argument('--windowed', action='store_true', help='Clip, palette-expand and write each chart block by block to bound memory use')
+    parser.add_argument('--block_size', type=int, default=1024, help='Block size in pixels for --windowed (default: 1024)')
+    parser.add_argument('--verify_colormap', action='store_true', help='Check the vectorized colormap output against the per-pixel output before writing each chart')
+    parser.add_argument('--force', action='store_true', help='Process every chart, even if its inputs are unchanged since the last run')
+    parser.add_argument('--lock', action='store_true', help='Lock each chart in ./locks/ while it is processed, for several runs sharing the target directory')
+    parser.add_argument('--report', type=str, default=None, help='Time each phase of each chart and write a JSON run report to this path, with a CSV of the charts next to it')
+    parser.add_argument('--profile_slowest', type=int, default=0, help='With --report, also save cProfile dumps of the N slowest charts (default: 0)')
     args = parser.parse_args()
 
     # Paths
@@ -154,7 +358,8 @@ def main():
 
     # Ensure output and lock folders exist
     os.makedirs(output_folder, exist_ok=True)
-    os.makedirs(lock_folder, exist_ok=True)
+    if args.lock:
+        os.makedirs(lock_folder, exist_ok=True)
 
     # Get the latest date from HTML metadata files
     latest_file, latest_date = get_latest_date_from_html(input_folder)
@@ -168,39 +373,75 @@ def main():
         if (datetime.now() - latest_date).days >= 56:
             print(Fore.YELLOW + 'Warning: Sectional charts are older than 56 days. Check for new updates at https://www.faa.gov/air_traffic/flight_info/aeronav/digital_products/vfr/' + Style.RESET_ALL)
 
-        # Initialize metadata
+        # Initialize metadata, carrying over the manifest of the previous run
+        previous_manifest = stage_manifest(load_metadata(output_folder), 'extract')
         update_metadata = {
             "last_updated": latest_iso,
             "maps": []
         }
+        manifest = stage_manifest(update_metadata, 'extract')
+        # Parameters that change the clipped output
+        params = {'keep_palette': args.keep_palette, 'windowed': args.windowed}
+        pending = {}
 
         # Process each GeoTIFF in the input folder
         tiff_files = [filename for filename in os.listdir(input_folder) if filename.endswith('.tif')]
         file_info_list = []
+        options = {'keep_palette': args.keep_palette, 'verify_colormap': args.verify_colormap}
+        if args.windowed:
+            options['block_size'] = args.block_size
 
         for filename in tiff_files:
             raster_path = os.path.join(input_folder, filename)
             shapefile_name = filename.replace('.tif', '.shp')
             shapefile_path = os.path.join(shapefile_folder, shapefile_name)
             output_path = os.path.join(output_folder, filename)
-            lock_path = os.path.join(lock_folder, filename + '.lock')
+            lock_path = os.path.join(lock_folder, filename + '.lock') if args.lock else None
 
             if os.path.exists(shapefile_path):
-                file_info_list.append((raster_path, shapefile_path, output_path, lock_path))
                 update_metadata["maps"].append({
                     "name": filename.replace('.tif', ''),
                     "last_updated": latest_iso
                 })
+                previous_entry = previous_manifest.get(filename, {})
+                previous_inputs = previous_entry.get('inputs', {})
+                inputs = {
+                    'raster': file_fingerprint(raster_path, previous_inputs.get('raster')),
+                    'shapefile': file_fingerprint(shapefile_path, previous_inputs.get('shapefile'))
+                }
+                if not args.force and is_up_to_date(previous_entry, inputs, params, output_path):
+                    manifest[filename] = previous_entry
+                    logging.info(f'Unchanged since the last run, skipping: {raster_path}')
+                    continue
+                file_info_list.append((raster_path, shapefile_path, output_path, lock_path, options))
+                pending[raster_path] = (filename, inputs)
             else:
                 logging.warning(f'Shapefile not found for {raster_path}')
 
-        # Use multiprocessing to process files
-        with multiprocessing.Pool(processes=args.num_processes) as pool:
-            list(tqdm(pool.imap(process_file, file_info_list), total=len(file_info_list), desc='Processing GeoTIFFs'))
+        if len(file_info_list) < len(update_metadata["maps"]):
+            print(f'{len(update_metadata["maps"]) - len(file_info_list)} charts unchanged since the last run.')
+        save_metadata(output_folder, update_metadata)
 
-        # Save the update metadata to a JSON file
-        with open(os.path.join(output_folder, 'update_metadata.json'), 'w') as json_file:
-            json.dump(update_metadata, json_file, indent=4)
+        # Process the charts largest first under the memory budget, recording each chart in the manifest as it completes
+        budget = memory_budget(args.memory_budget_mb)
+        jobs = [(os.path.basename(file_info[0]), estimate_working_set(file_info[0], options), file_info) for file_info in file_info_list]
+        if jobs:
+            message = f"Processing {len(jobs)} charts on up to {args.num_processes} processes, largest estimated at {format_mb(max(job[1] for job in jobs))}, memory budget {format_mb(budget) if budget else 'unlimited'}"
+            logging.info(message)
+            print(message)
+        run_report = RunReport('extract', args.report, args.num_processes, args.profile_slowest) if args.report else None
+        pool_options = {'initializer': instrument.enable, 'initargs': (args.profile_slowest,)} if run_report else {}
+        scheduled = run_scheduled(process_file, jobs, args.num_processes, budget, lambda result: result[1], args.retries, **pool_options)
+        for file_info, result in tqdm(scheduled, total=len(jobs), desc='Processing GeoTIFFs'):
+            raster_path, succeeded, record = result or (file_info[0], False, None)
+            if run_report:
+                run_report.add(record)
+            if succeeded:
+                filename, inputs = pending[raster_path]
+                manifest[filename] = {'inputs': inputs, 'params': params}
+                save_metadata(output_folder, update_metadata)
+        if run_report:
+            run_report.write()
 
         logging.info('Update metadata JSON file created successfully.')
     else:
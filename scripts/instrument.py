@@ -0,0 +1,168 @@
+import os
+import csv
+import json
+import time
+import heapq
+import marshal
+import cProfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Opt-in instrumentation shared by the scripts. While a process works on an item (a chart or a
+# tile) it adds up the time spent in each phase and a few counters; the worker sends the record
+# back with its result and the parent process adds them up in a RunReport. Everything here is a
+# no-op until enable() is called, so the scripts pay nothing when it is off.
+
+enabled = False
+profile_slowest = 0
+phase_seconds = defaultdict(float)
+counters = defaultdict(int)
+item_started = None
+profiler = None
+# Durations of the slowest items this process has profiled, so only likely top-N profiles are sent
+profiled_seconds = []
+
+# Turn instrumentation on in this process, optionally profiling items with cProfile
+def enable(profile=0):
+    global enabled, profile_slowest
+    enabled = True
+    profile_slowest = profile
+
+# Time a phase of the current item
+@contextmanager
+def phase(name):
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_seconds[name] += time.perf_counter() - started
+
+# Add to a counter of the current item
+def count(name, amount=1):
+    if enabled:
+        counters[name] += amount
+
+# Add phase times and counters measured outside the current item's thread, such as by an encoder
+# thread, to an item's record (or to the current item if record is None)
+def add_to_item(record, phases=None, counts=None):
+    if not enabled:
+        return
+    item = {'phases': phase_seconds, 'counters': counters} if record is None else record
+    for name, seconds in (phases or {}).items():
+        item['phases'][name] = item['phases'].get(name, 0) + seconds
+    for name, amount in (counts or {}).items():
+        item['counters'][name] = item['counters'].get(name, 0) + amount
+
+def start_item():
+    global item_started, profiler
+    if not enabled:
+        return
+    phase_seconds.clear()
+    counters.clear()
+    item_started = time.perf_counter()
+    if profile_slowest:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+# Finish the current item, returns its record for the parent (None when instrumentation is off)
+def finish_item(name):
+    global profiler
+    if not enabled:
+        return None
+    seconds = time.perf_counter() - item_started
+    record = {'item': name, 'pid': os.getpid(), 'seconds': seconds, 'phases': dict(phase_seconds), 'counters': dict(counters)}
+    if profiler is not None:
+        profiler.disable()
+        if len(profiled_seconds) < profile_slowest or seconds > profiled_seconds[0]:
+            heapq.heappush(profiled_seconds, seconds)
+            if len(profiled_seconds) > profile_slowest:
+                heapq.heappop(profiled_seconds)
+            # The same marshalled stats pstats writes to a .prof file
+            profiler.create_stats()
+            record['profile'] = marshal.dumps(profiler.stats)
+        profiler = None
+    return record
+
+# Collects the item records of a run in the parent process and writes the report
+class RunReport:
+    def __init__(self, stage, report_path, workers, profile_slowest=0):
+        self.stage = stage
+        self.report_path = report_path
+        self.workers = workers
+        self.profile_slowest = profile_slowest
+        self.started = time.perf_counter()
+        self.records = []
+        self.profiles = []  # min-heap of (seconds, order, item, profile data)
+
+    def add(self, record):
+        if record is None:
+            return
+        profile = record.pop('profile', None)
+        if profile is not None:
+            entry = (record['seconds'], len(self.records), record['item'], profile)
+            if len(self.profiles) < self.profile_slowest:
+                heapq.heappush(self.profiles, entry)
+            else:
+                heapq.heappushpop(self.profiles, entry)
+        self.records.append(record)
+
+    # Totals, per-worker utilisation and the slowest items
+    def summary(self):
+        wall_seconds = time.perf_counter() - self.started
+        phases = defaultdict(float)
+        counters = defaultdict(int)
+        busy = defaultdict(float)
+        for record in self.records:
+            for name, seconds in record['phases'].items():
+                phases[name] += seconds
+            for name, amount in record['counters'].items():
+                counters[name] += amount
+            busy[record['pid']] += record['seconds']
+        busy_seconds = sum(busy.values())
+
+        summary = {
+            'stage': self.stage,
+            'wall_seconds': round(wall_seconds, 3),
+            'items': len(self.records),
+            'busy_seconds': round(busy_seconds, 3),
+            'phases': {name: {'seconds': round(seconds, 3), 'share': round(seconds / busy_seconds, 4) if busy_seconds else 0}
+                       for name, seconds in sorted(phases.items(), key=lambda phase: -phase[1])},
+            'counters': dict(counters),
+            # Share of the run's wall time the pool's workers spent working on items
+            'utilisation': round(busy_seconds / (wall_seconds * self.workers), 4) if wall_seconds else 0,
+            'workers': {str(pid): {'busy_seconds': round(seconds, 3), 'utilisation': round(seconds / wall_seconds, 4)}
+                        for pid, seconds in busy.items()},
+            'slowest': [{'item': record['item'], 'seconds': round(record['seconds'], 4)}
+                        for record in sorted(self.records, key=lambda record: -record['seconds'])[:10]],
+        }
+        if 'tiles' in counters:
+            summary['empty_tile_rate'] = round(counters.get('empty_tiles', 0) / counters['tiles'], 4) if counters['tiles'] else 0
+        return summary
+
+    # Write the JSON summary, a CSV with one row per item, and the slowest items' profiles
+    def write(self):
+        base_path = os.path.splitext(self.report_path)[0]
+        with open(self.report_path, 'w') as report_file:
+            json.dump(self.summary(), report_file, indent=4)
+
+        phase_names = sorted({name for record in self.records for name in record['phases']})
+        counter_names = sorted({name for record in self.records for name in record['counters']})
+        with open(base_path + '_items.csv', 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['item', 'pid', 'seconds'] + [f'{name}_seconds' for name in phase_names] + counter_names)
+            for record in self.records:
+                writer.writerow([record['item'], record['pid'], round(record['seconds'], 6)]
+                                + [round(record['phases'].get(name, 0), 6) for name in phase_names]
+                                + [record['counters'].get(name, 0) for name in counter_names])
+
+        if self.profiles:
+            profile_dir = base_path + '_profiles'
+            os.makedirs(profile_dir, exist_ok=True)
+            for seconds, _, item, profile in sorted(self.profiles, reverse=True):
+                # Load with pstats.Stats(path) or snakeviz
+                with open(os.path.join(profile_dir, item.replace('/', '_').replace(' ', '_') + '.prof'), 'wb') as profile_file:
+                    profile_file.write(profile)
+        print(f'Run report written to {self.report_path}')
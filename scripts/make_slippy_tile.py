@@ -2,163 +2,1178 @@ import os
 import numpy as np
 import rasterio
 import mercantile
+from shapely.geometry import box, mapping, shape, GeometryCollection, Polygon
+from shapely.ops import unary_union
+from shapely.prepared import prep
 from PIL import Image
-from rasterio.warp import reproject, Resampling, transform_bounds
-from rasterio.transform import from_bounds
+from rasterio.warp import reproject, Resampling, transform_bounds, transform_geom
+from rasterio.transform import from_bounds, from_origin
+from rasterio.features import shapes
+from affine import Affine
 from multiprocessing import Pool, cpu_count
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from filelock import FileLock
 from decimal import Decimal, getcontext
 from tqdm import tqdm
 import argparse
-import shutil
 import logging
+import time
+import io
+from tile_sinks import DirectorySink, open_sink, sink_kinds
+from tile_encoders import tile_formats, tile_extension, alpha_coverage, encode_tile, rgba_to_indexed
+from chart_vrt import open_clipped_chart, open_raw_chart
+from instrument import RunReport
+import instrument
+from manifest import load_metadata, save_metadata, stage_manifest, file_fingerprint
 
 # Set precision for Decimal calculations
 getcontext().prec = 20
 target_crs = 'EPSG:4326'
+# Metatiles are warped in web mercator, the only CRS where tile edges fall on a regular pixel grid
+metatile_crs = 'EPSG:3857'
 
-# Configure logging
-logging.basicConfig(filename='tiles.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+# Defaults for the worker pool, overridable from the command line
+default_options = {
+    'dataset_cache_size': 8,  # open datasets kept per worker
+    'gdal_cache_mb': 256,  # GDAL block cache per worker
+    'chunk_size': 0,  # tiles handed to a worker at a time, 0 to pick from the tile count
+    'pyramid': False,  # warp only the max zoom and build lower zooms from their children
+    'resampling': 'bilinear',  # filter used to downsample children in pyramid mode
+    'metatile': 1,  # warp NxN blocks of tiles in one pass when greater than 1
+    'metatile_buffer': 16,  # extra pixels warped around each metatile
+    'force': False,  # render every tile even if the charts under it are unchanged
+    'sink': 'dir',  # where tiles are written: dir, mbtiles or pmtiles
+    'indexed': False,  # warp paletted charts as indices and write palette (PNG8) tiles
+    'indexed_resampling': 'nearest',  # how palette indices are resampled in indexed mode
+    'cutlines': None,  # raw chart path -> shapefile, for charts clipped on the fly by the fused pipeline
+    'report': None,  # path of the instrumentation report, None to leave instrumentation off
+    'profile_slowest': 0,  # cProfile dumps kept for the slowest tiles when instrumented
+    'lock_tiles': False,  # lock each tile file, only needed when several runs write one directory at once
+    'shard': None,  # 'i/N' to render only shard i (counting from 0) of N disjoint shares of the tiles
+    'tile_format': 'png',  # encoding of the tiles, one of tile_encoders.tile_formats
+    'png_level': 6,  # zlib compression level of PNG tiles, 0-9
+    'quality': 85,  # quality of lossy WebP and JPEG tiles, 1-100
+    'encode_threads': 1,  # threads per worker encoding and writing tiles while the next renders, 0 to encode inline
+}
+
+# Options that change the rendered tiles; a change to any of them re-renders the whole zoom level
+output_options = ['pyramid', 'resampling', 'metatile', 'metatile_buffer', 'sink', 'indexed', 'indexed_resampling', 'shard',
+                  'tile_format', 'png_level', 'quality']
+
+# PIL filters for downsampling children into their parent tile
+pyramid_resampling = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
+# Warp resampling for palette indices; only methods that pick an existing index are valid
+index_resampling = {
+    'nearest': Resampling.nearest,
+    'mode': Resampling.mode,
+}
+
+# Per-worker LRU of open datasets and its hit/miss counters, set up by init_worker
+dataset_cache = OrderedDict()
+dataset_cache_size = default_options['dataset_cache_size']
+cache_stats = {'hits': 0, 'misses': 0}
+gdal_env = None
+# Per-worker overview factors, CRS and pixel size of each chart, for picking the overview to read
+chart_overviews = {}
+# With an archive sink, workers queue encoded tiles here (None to delete) for the parent to write
+archive_output = False
+pending_tiles = []
+# Tiles the worker saved (True) or found empty (False) since its last work item
+saved_tiles = []
+# In indexed mode, the index_resampling name the worker warps with (None for RGBA tiles)
+indexed_output = None
+# Raw charts the worker clips on the fly, mapped to their shapefiles
+chart_cutlines = {}
+# Warp options that clip each raw chart the worker has open to its shapefile, by dataset
+chart_clips = {}
+# Whether the worker locks tile files; a single run hands each tile to exactly one worker
+lock_tiles = False
+# Instrumentation records of the current run, collected in the parent process
+run_report = None
+# The worker's tile encoding settings and its encoder threads (None to encode inline)
+tile_encoding = {'tile_format': default_options['tile_format'], 'png_level': default_options['png_level'], 'quality': default_options['quality']}
+encoder = None
+# Encodes started during the current work item as (tile, future), and those of finished items as
+# (tile, future, instrumentation record); all of them are waited for at the end of the batch
+item_encodes = []
+batch_encodes = []
+# Futures of the encodes not yet known to be done, oldest first, and how many may be queued; this
+# bounds the tile images the worker holds in memory
+queued_encodes = deque()
+max_queued_encodes = 0
 
 # Find all GeoTIFF files in the directory
 def find_all_geotiffs(directory):
     return [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith('.tif') or file.endswith('.tiff')]
 
-# Function to process a single tile
+# Open a chart, clipping it to its shapefile through a warped VRT if it is a raw chart. Only the
+# footprint index reads raw charts this way; tile warps clip them with open_raw_chart's cutline.
+def open_chart(geotiff_path, cutlines=None, keep_palette=False):
+    if cutlines and geotiff_path in cutlines:
+        return open_clipped_chart(geotiff_path, cutlines[geotiff_path], keep_palette)
+    return rasterio.open(geotiff_path)
+
+# Build the footprint index of the source charts: lat/lon bounds of each GeoTIFF plus the
+# outline of its valid (clipped) pixels and the interior that is certainly inside it
+def build_chart_index(geotiff_paths, mask_size=1024, cutlines=None, keep_palette=False):
+    chart_index = []
+    for geotiff_path in geotiff_paths:
+        with open_chart(geotiff_path, cutlines, keep_palette) as dataset:
+            bounds = transform_bounds(dataset.crs, target_crs, *dataset.bounds)
+            footprint, interior = chart_footprint(dataset, mask_size)
+            paletted = dataset.count == 1 and dataset.colorinterp[0] == rasterio.enums.ColorInterp.palette
+        chart_index.append({'path': geotiff_path, 'bounds': bounds, 'footprint': footprint, 'interior': interior, 'paletted': paletted})
+    return chart_index
+
+# Indexed mode needs every chart to be a single paletted band; reports the ones that aren't
+def check_indexed_charts(chart_index):
+    unpaletted = [os.path.basename(chart['path']) for chart in chart_index if not chart['paletted']]
+    if unpaletted:
+        print(f"Indexed tiles need paletted charts (extract them with --keep_palette), these are not: {', '.join(unpaletted)}")
+    return not unpaletted
+
+# Outline of the clip polygon as it ended up in the raster, traced from a decimated read of the
+# dataset mask. The shapefile polygons can't be used directly because their edges are straight in
+# the chart's Lambert projection, not in lat/lon. Returns the outline padded outwards, which may
+# only overlap tiles the chart touches, and shrunk inwards, which only holds pixels with chart data.
+def chart_footprint(dataset, mask_size=1024):
+    scale = max(dataset.width / mask_size, dataset.height / mask_size, 1)
+    out_height, out_width = int(np.ceil(dataset.height / scale)), int(np.ceil(dataset.width / scale))
+    valid = dataset.dataset_mask(out_shape=(out_height, out_width))
+    mask_transform = dataset.transform * Affine.scale(dataset.width / out_width, dataset.height / out_height)
+
+    polygons = [shape(geom) for geom, _ in shapes(valid, mask=valid > 0, transform=mask_transform)]
+    if not polygons:
+        return box(0, 0, 0, 0), box(0, 0, 0, 0)
+    # Pad by a couple of decimated pixels so thin slivers lost to the decimation stay inside,
+    # and shrink by as much (which also clears the warp kernel at the edge) for the interior
+    outline = unary_union(polygons)
+    pad = 2 * max(abs(mask_transform.a), abs(mask_transform.e))
+    footprint = shape(transform_geom(dataset.crs, target_crs, mapping(outline.buffer(pad))))
+    # Holes are dark chart pixels that read as nodata, not edges, so the interior ignores them
+    interior = unary_union([Polygon(polygon.exterior) for polygon in getattr(outline, 'geoms', [outline])]).buffer(-pad)
+    interior = shape(transform_geom(dataset.crs, target_crs, mapping(interior))) if not interior.is_empty else box(0, 0, 0, 0)
+    return footprint, interior
+
+# Find the charts whose footprint intersects the tile
+def charts_for_tile(chart_index, tile):
+    tile_west, tile_south, tile_east, tile_north = mercantile.bounds(tile)
+    tile_box = box(tile_west, tile_south, tile_east, tile_north)
+    geotiff_paths = []
+    for chart in chart_index:
+        west, south, east, north = chart['bounds']
+        if west > tile_east or east < tile_west or south > tile_north or north < tile_south:
+            continue
+        if 'prepared' not in chart:
+            chart['prepared'] = prep(chart['footprint'])
+        if chart['prepared'].intersects(tile_box):
+            geotiff_paths.append(chart['path'])
+    return geotiff_paths
+
+# Split tiles by chart coverage. Returns the charts touching each covered tile, the tiles outside
+# every chart (which are never rendered) and how many covered tiles lie inside a single chart's
+# interior; the rest are on seams, at a chart edge or where charts overlap.
+def classify_tiles(chart_index, tiles):
+    interiors = {chart['path']: chart for chart in chart_index}
+    covered = {}
+    outside = []
+    inside = 0
+    for tile in tiles:
+        geotiff_paths = charts_for_tile(chart_index, tile)
+        if not geotiff_paths:
+            outside.append(tile)
+            continue
+        covered[tile] = geotiff_paths
+        if len(geotiff_paths) == 1:
+            chart = interiors[geotiff_paths[0]]
+            if 'prepared_interior' not in chart:
+                chart['prepared_interior'] = prep(chart['interior'])
+            if chart['prepared_interior'].contains(box(*mercantile.bounds(tile))):
+                inside += 1
+    return covered, outside, inside
+
+# Print the tile counts of a zoom level by chart coverage
+def report_coverage(label, covered, outside, inside):
+    message = f"{label}: {len(covered)} tiles to render ({inside} inside a single chart, {len(covered) - inside} on seams), {len(outside)} outside the charts skipped"
+    logging.info(message)
+    print(message)
+
+# Remove tiles left outside the charts by an earlier run (only where the charts changed)
+def remove_outside_tiles(outside, sink, dirty=None):
+    for tile in outside:
+        if is_dirty(tile, dirty):
+            sink.delete(tile)
+
+# Pool initializer: give the worker a long-lived dataset cache and GDAL block cache
+def init_worker(cache_size, gdal_cache_mb, archive=False, indexed=None, cutlines=None, profile_slowest=None, lock=False, encoding=None, encode_threads=0):
+    global dataset_cache_size, gdal_env, archive_output, indexed_output, chart_cutlines, lock_tiles, encoder, max_queued_encodes
+    dataset_cache_size = cache_size
+    lock_tiles = lock
+    archive_output = archive
+    indexed_output = indexed
+    chart_cutlines = cutlines or {}
+    tile_encoding.update(encoding or {})
+    encoder = ThreadPoolExecutor(encode_threads) if encode_threads else None
+    max_queued_encodes = 4 * encode_threads
+    if profile_slowest is not None:
+        instrument.enable(profile_slowest)
+    dataset_cache.clear()
+    chart_overviews.clear()
+    chart_clips.clear()
+    gdal_env = rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb)
+    gdal_env.__enter__()
+
+# Get an open dataset (or one of its overviews) from the worker's LRU cache, opening it (and
+# evicting the oldest) on a miss
+def get_dataset(geotiff_path, overview=None):
+    key = geotiff_path if overview is None else (geotiff_path, overview)
+    if key in dataset_cache:
+        cache_stats['hits'] += 1
+        dataset_cache.move_to_end(key)
+        return dataset_cache[key]
+
+    cache_stats['misses'] += 1
+    with instrument.phase('open'):
+        if overview is None and geotiff_path in chart_cutlines:
+            dataset, chart_clips[dataset] = open_raw_chart(geotiff_path, chart_cutlines[geotiff_path], indexed_output is not None)
+        elif overview is None:
+            dataset = rasterio.open(geotiff_path)
+        else:
+            dataset = rasterio.open(geotiff_path, overview_level=overview)
+    dataset_cache[key] = dataset
+    while len(dataset_cache) > dataset_cache_size:
+        _, evicted = dataset_cache.popitem(last=False)
+        chart_clips.pop(evicted, None)
+        evicted.close()
+    return dataset
+
+# Distance of a tile along the Hilbert curve over its zoom level. Unlike the quadkey (Z-order)
+# curve it never jumps across the grid, so consecutive tiles are always neighbours.
+def hilbert_index(tile):
+    x, y = tile.x, tile.y
+    index = 0
+    side = 1 << tile.z
+    s = side >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve inside it is in the standard orientation
+        if ry == 0:
+            if rx == 1:
+                x, y = side - 1 - x, side - 1 - y
+            x, y = y, x
+        s >>= 1
+    return index
+
+# The overview of a chart to warp a tile from: the coarsest one that is still at least as fine as
+# the tile's pixels (within 5%), or None for full resolution. Charts reprojected with --cog have
+# overviews on the tile zoom levels, so lower zooms read one overview block instead of decimating.
+def chart_overview(geotiff_path, tile):
+    if geotiff_path in chart_cutlines:
+        return None
+    if geotiff_path not in chart_overviews:
+        dataset = get_dataset(geotiff_path)
+        chart_overviews[geotiff_path] = (dataset.overviews(1), dataset.crs, abs(dataset.transform.a))
+    factors, crs, res = chart_overviews[geotiff_path]
+    if not factors:
+        return None
+    west, _, east, _ = transform_bounds(target_crs, crs, *mercantile.bounds(tile))
+    wanted = (east - west) / 512 / res
+    overview = None
+    for level, factor in enumerate(factors):
+        if factor <= wanted * 1.05:
+            overview = level
+    return overview
+
+# Order tiles along the Hilbert curve. Each chunk of the ordered list goes to a single worker, so
+# every tile has exactly one owner and a worker's tiles share charts and GDAL cache blocks.
+def sort_tile_infos(tile_infos):
+    return sorted(tile_infos, key=lambda tile_info: hilbert_index(tile_info[2]))
+
+# Parse a --shard argument: 'i/N' with 0 <= i < N
+def shard_spec(text):
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must be given as i/N, not '{text}'")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"shard count must be at least 1, not {count}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}, not {index}")
+    return f'{index}/{count}'
+
+# Deal weighted groups to shards, heaviest first, each to the least loaded shard. Ties are broken
+# by key and shard number, so every node computes the same assignment from the same charts.
+def assign_groups(weights, count):
+    loads = [0] * count
+    owners = {}
+    for key in sorted(weights, key=lambda key: (-weights[key], key)):
+        shard = min(range(count), key=lambda shard: (loads[shard], shard))
+        owners[key] = shard
+        loads[shard] += weights[key]
+    return owners
+
+# The share of a zoom level's tiles (mapped to their charts) that belongs to a shard. Tiles are
+# grouped by quadkey prefix, at the lowest zoom giving at least eight groups per shard, and the
+# groups are balanced by their warps.
+def shard_tiles(tiles, shard):
+    if not tiles:
+        return {}
+    index, count = (int(part) for part in shard.split('/'))
+    zoom_level = next(iter(tiles)).z
+    prefix_zoom = next((zoom for zoom in range(zoom_level + 1)
+                        if len({ancestor(tile, zoom) for tile in tiles}) >= 8 * count), zoom_level)
+    weights = defaultdict(int)
+    for tile, geotiff_paths in tiles.items():
+        weights[mercantile.quadkey(ancestor(tile, prefix_zoom))] += len(geotiff_paths)
+    owners = assign_groups(weights, count)
+    return {tile: geotiff_paths for tile, geotiff_paths in tiles.items()
+            if owners[mercantile.quadkey(ancestor(tile, prefix_zoom))] == index}
+
+# Record a shard's share of a zoom level in the tiles manifest for merge_shards.py: the tiles it
+# owns, how many tiles the zoom has across all shards, and which of its tiles are empty (and so
+# have no file). saved maps the tiles rendered by this run to whether they were saved. assigned is
+# None for a pyramid zoom that merge_shards.py builds from the merged zoom below.
+def record_shard(tiles_manifest, shard, zoom_level, assigned, total, saved):
+    record = tiles_manifest.setdefault('shard', {})
+    if record.get('spec') != shard:
+        record.clear()
+        record.update({'spec': shard, 'zooms': {}})
+    if assigned is None:
+        record['zooms'][str(zoom_level)] = {'total': total, 'from_zoom_below': True}
+        return
+    empty = set(record['zooms'].get(str(zoom_level), {}).get('empty', []))
+    for tile, was_saved in saved.items():
+        if was_saved:
+            empty.discard(mercantile.quadkey(tile))
+        else:
+            empty.add(mercantile.quadkey(tile))
+    assigned = sorted(mercantile.quadkey(tile) for tile in assigned)
+    record['zooms'][str(zoom_level)] = {'total': total, 'assigned': assigned, 'empty': sorted(empty.intersection(assigned))}
+
+# Tiles handed to a worker at a time: about eight chunks per worker keeps the workers busy to the
+# end of a zoom level, capped so the progress bar still moves on large zooms
+def auto_chunk_size(count, workers):
+    return max(1, min(64, count // (workers * 8)))
+
+# Statistics a worker returns for one work item, along with the tiles it queued for an archive sink
+# and, when instrumented, the item's timers and counters. Tiles still encoding are handed to the
+# batch, which adds them (and their encode times) once they are done.
+def worker_stats(warps, hits, misses, item=None):
+    tiles = pending_tiles[:]
+    pending_tiles.clear()
+    saved = saved_tiles[:]
+    saved_tiles.clear()
+    instrument.count('warps', warps)
+    record = instrument.finish_item(item)
+    batch_encodes.extend((tile, future, record) for tile, future in item_encodes)
+    item_encodes.clear()
+    return {'warps': warps, 'cache_hits': cache_stats['hits'] - hits, 'cache_misses': cache_stats['misses'] - misses, 'tiles': tiles,
+            'saved': saved, 'instrumentation': record}
+
+# Pool task: run a worker over a batch of work items. Each item's tiles encode on the encoder
+# threads while the next item renders; the batch returns once all of them are written, with the
+# statistics of its items added up.
+def process_batch(batch):
+    worker, work_items = batch
+    totals = {'items': len(work_items), 'warps': 0, 'cache_hits': 0, 'cache_misses': 0, 'tiles': [], 'saved': [], 'instrumentation': []}
+    for work_item in work_items:
+        stats = worker(work_item)
+        for key in ('warps', 'cache_hits', 'cache_misses', 'tiles', 'saved'):
+            totals[key] += stats[key]
+        if stats['instrumentation'] is not None:
+            totals['instrumentation'].append(stats['instrumentation'])
+
+    for tile, future, record in batch_encodes:
+        tile_saved(tile, *future.result(), record)
+    batch_encodes.clear()
+    queued_encodes.clear()
+    totals['tiles'] += pending_tiles
+    pending_tiles.clear()
+    totals['saved'] += saved_tiles
+    saved_tiles.clear()
+    return totals
+
+# Name of a tile in reports
+def tile_name(tile):
+    return f'{tile.z}/{tile.x}/{tile.y}'
+
+# Start collecting instrumentation records for a run if a report was asked for
+def start_run_report(options):
+    global run_report
+    if options['report']:
+        run_report = RunReport('tiles', options['report'], cpu_count(), options['profile_slowest'])
+
+# Write the instrumentation report of the run, if there is one
+def finish_run_report():
+    global run_report
+    if run_report is not None:
+        run_report.write()
+        run_report = None
+
+# Render the tiles on a worker pool and report warp and dataset cache statistics.
+# possible_warps is the number of warps there would be warping every chart for every tile.
+# Tiles the workers send back are written to the sink by this (the only writing) process.
+def run_tiles(tile_infos, possible_warps, desc, options=None, worker=None, sink=None, saved=None):
+    options = {**default_options, **(options or {})}
+    totals = {'warps': 0, 'cache_hits': 0, 'cache_misses': 0}
+    archive = sink is not None and not sink.workers_write
+    indexed = options['indexed_resampling'] if options['indexed'] else None
+    profile_slowest = options['profile_slowest'] if options['report'] else None
+    chunk_size = options['chunk_size'] or auto_chunk_size(len(tile_infos), cpu_count())
+    encoding = {key: options[key] for key in tile_encoding}
+    # The chunks are handed out as batches, so the tiles of one item encode while the next renders
+    tile_infos = sort_tile_infos(tile_infos)
+    batches = [(worker or process_tile, tile_infos[start:start + chunk_size]) for start in range(0, len(tile_infos), chunk_size)]
+
+    with Pool(cpu_count(), initializer=init_worker, initargs=(options['dataset_cache_size'], options['gdal_cache_mb'], archive, indexed, options['cutlines'],
+                                                              profile_slowest, options['lock_tiles'], encoding, options['encode_threads'])) as pool, \
+            tqdm(total=len(tile_infos), desc=desc) as progress:
+        for stats in pool.imap_unordered(process_batch, batches):
+            progress.update(stats['items'])
+            for key in totals:
+                totals[key] += stats[key]
+            if run_report is not None:
+                for record in stats['instrumentation']:
+                    run_report.add(record)
+            if saved is not None:
+                saved.update(stats['saved'])
+            for tile, data in stats['tiles']:
+                if data is None:
+                    sink.delete(tile)
+                else:
+                    sink.write(tile, data)
+
+    warps_skipped = possible_warps - totals['warps']
+    lookups = totals['cache_hits'] + totals['cache_misses']
+    hit_rate = totals['cache_hits'] / lookups if lookups else 0
+    if worker is process_metatile:
+        # A metatile warp covers many tiles, so it isn't comparable to the per-tile count
+        message = f"{desc}: {totals['warps']} metatile warps performed instead of {possible_warps} per-tile warps, dataset cache hit rate {hit_rate:.1%}"
+    elif worker is not process_parent_tile:
+        message = f"{desc}: {totals['warps']} warps performed, {warps_skipped} skipped by the chart index, dataset cache hit rate {hit_rate:.1%}"
+    else:
+        message = f"{desc}: {len(tile_infos)} tiles built from the zoom level below"
+    logging.info(message)
+    print(message)
+    return totals
+
+# Function to process a single tile, returns the number of warps and dataset cache hits/misses
 def process_tile(tile_info):
     geotiff_paths, zoom_level, tile, tiles_dir = tile_info
 
-    tile_dir = os.path.join(tiles_dir, str(tile.z), str(tile.x))
-    os.makedirs(tile_dir, exist_ok=True)
-    tile_path = os.path.join(tile_dir, f'{tile.y}.png')
-    lock_path = tile_path + '.lock'
-    
-    with FileLock(lock_path):
-        tile_img = Image.new('RGBA', (512, 512), (0, 0, 0, 0))
+    instrument.start_item()
+    hits, misses = cache_stats['hits'], cache_stats['misses']
+    tile_img = render_tile(geotiff_paths, tile)
+    save_tile(tile_img, tile, tiles_dir)
+    return worker_stats(len(geotiff_paths), hits, misses, tile_name(tile))
+
+# Warp the charts into a single tile image
+def render_tile(geotiff_paths, tile):
+    tile_bounds = mercantile.bounds(tile)
+    dst_transform = from_bounds(
+        float(Decimal(tile_bounds.west)),
+        float(Decimal(tile_bounds.south)),
+        float(Decimal(tile_bounds.east)),
+        float(Decimal(tile_bounds.north)),
+        512, 512
+    )
+
+    if indexed_output:
+        codes = np.zeros((512, 512), dtype=np.uint16)
+        colormaps = []
+        for slot, geotiff_path in enumerate(geotiff_paths):
+            dataset = get_dataset(geotiff_path, chart_overview(geotiff_path, tile))
+            composite_indices(codes, warp_indices(dataset, dst_transform, 512, 512, target_crs), slot, chart_nodata(dataset))
+            colormaps.append(dataset.colormap(1))
+        return indexed_image(codes, colormaps)
+
+    if len(geotiff_paths) == 1:
+        dataset = get_dataset(geotiff_paths[0], chart_overview(geotiff_paths[0], tile))
+        return single_chart_tile(warp_chart(dataset, dst_transform, 512, 512, target_crs))
+
+    tile_img = Image.new('RGBA', (512, 512), (0, 0, 0, 0))
         
-        for geotiff_path in geotiff_paths:
-            with rasterio.open(geotiff_path) as dataset:
-                tile_bounds = mercantile.bounds(tile)
-                dst_transform = from_bounds(
-                    float(Decimal(tile_bounds.west)),
-                    float(Decimal(tile_bounds.south)),
-                    float(Decimal(tile_bounds.east)),
-                    float(Decimal(tile_bounds.north)),
-                    512, 512
-                )
-                
-                reprojected_data = np.zeros((dataset.count, 512, 512), dtype=np.uint8)
-                # logging.info(f"Dataset {dataset}")
-                for i in range(dataset.count):
-                    reprojected_band = np.zeros((512, 512), dtype=np.float32)
-                    reproject(
-                        source=rasterio.band(dataset, i + 1),
-                        destination=reprojected_band,
-                        src_transform=dataset.transform,
-                        src_crs=dataset.crs,
-                        dst_transform=dst_transform,
-                        dst_crs=target_crs,
-                        resampling=Resampling.bilinear
-                    )
-                    min_val = np.min(reprojected_band)
-                    max_val = np.max(reprojected_band)
-                    
-                    if min_val != max_val:
-                        reprojected_band = ((reprojected_band - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-                    else:
-                        reprojected_band = np.zeros_like(reprojected_band, dtype=np.uint8)
-                    
-                    reprojected_data[i] = reprojected_band
-                    # logging.info(f"Reprojected band {i} x={tile.x} y={tile.y} {reprojected_band}")
-                
-                # Check if alpha band is present and valid
-                if dataset.count == 4 and not np.all(reprojected_data[3] == 0):
-                    reprojected_image = Image.merge("RGBA", [Image.fromarray(reprojected_data[i], 'L') for i in range(4)])
-                else:
-                    # Create alpha channel based on non-zero values in RGB channels
-                    alpha_channel = (np.max(reprojected_data[:3], axis=0) > 0).astype(np.uint8) * 255
-                    reprojected_image = Image.merge("RGBA", [Image.fromarray(reprojected_data[i], 'L') for i in range(3)] + [Image.fromarray(alpha_channel, 'L')])
-                
-                # Create a mask to handle transparency
-                mask = Image.fromarray((np.max(reprojected_data[:3], axis=0) > 0).astype(np.uint8) * 255, 'L')
-                
-                # Merge the reprojected image with the existing tile image
-                tile_img.paste(reprojected_image, (0, 0), mask)
-
-        # Debugging: Check tile data before saving
-        data = np.array(tile_img)
-        alpha_channel = data[:, :, 3]
-        # print(f"Tile {tile_path} alpha channel unique values: {np.unique(alpha_channel)}")
-
-        # Check if the entire tile is transparent
-        if np.all(alpha_channel == 0):
-            logging.info(f"Tile {tile_path} is fully transparent.")
+    for geotiff_path in geotiff_paths:
+        dataset = get_dataset(geotiff_path, chart_overview(geotiff_path, tile))
+        composite_chart(tile_img, warp_chart(dataset, dst_transform, 512, 512, target_crs))
+
+    return tile_img
+
+# Warp every band of a chart onto the destination grid, returns a float32 (bands, rows, cols) array.
+# One warp covers all the bands, so the source is read (and any cutline rasterized) once per tile.
+def warp_chart(dataset, dst_transform, width, height, dst_crs):
+    warped = np.zeros((dataset.count, height, width), dtype=np.float32)
+    # logging.info(f"Dataset {dataset}")
+    with instrument.phase('warp'):
+        reproject(
+            source=rasterio.band(dataset, list(range(1, dataset.count + 1))),
+            destination=warped,
+            src_transform=dataset.transform,
+            src_crs=dataset.crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            resampling=Resampling.bilinear,
+            **chart_clips.get(dataset, {})
+        )
+    return warped
+
+# The palette index used for nodata in a paletted chart
+def chart_nodata(dataset):
+    return int(dataset.nodata) if dataset.nodata is not None else 0
+
+# Warp the palette indices of a paletted chart onto the destination grid without blending them,
+# returns a uint8 (rows, cols) array with the chart's nodata index outside the chart
+def warp_indices(dataset, dst_transform, width, height, dst_crs):
+    nodata = chart_nodata(dataset)
+    warped = np.full((height, width), nodata, dtype=np.uint8)
+    with instrument.phase('warp'):
+        reproject(
+            source=rasterio.band(dataset, 1),
+            destination=warped,
+            src_transform=dataset.transform,
+            src_crs=dataset.crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            dst_nodata=nodata,
+            resampling=index_resampling[indexed_output],
+            **dict(chart_clips.get(dataset, {}), src_nodata=nodata)
+        )
+    return warped
+
+# Merge one chart's warped indices into a tile's codes. Code 0 is transparent and the chart in
+# slot k uses codes 256k + 1 to 256k + 256, so charts with different colormaps can share a tile.
+def composite_indices(codes, warped, slot, nodata):
+    with instrument.phase('merge'):
+        valid = warped != nodata
+        # Widen before adding: the uint8 indices would overflow (or, under NumPy 2, refuse the offset)
+        codes[valid] = warped[valid].astype(np.uint16) + np.uint16(256 * slot + 1)
+
+# Build a palette (PNG8) tile from composited codes and the colormaps of the charts in slot order.
+# Only the colours the tile uses go in its palette, with index 0 transparent.
+def indexed_image(codes, colormaps):
+    with instrument.phase('palette'):
+        return palette_image(codes, colormaps)
+
+def palette_image(codes, colormaps):
+    lut = np.zeros((256 * len(colormaps) + 1, 3), dtype=np.uint8)
+    for slot, colormap in enumerate(colormaps):
+        for index, color in colormap.items():
+            lut[256 * slot + 1 + index] = color[:3]
+
+    used = np.bincount(codes.ravel(), minlength=len(lut)) > 0
+    used[0] = True
+    if np.count_nonzero(used) > 256:
+        # Overlapping charts used more colours than a palette holds, quantize the RGB result
+        alpha = np.where(codes > 0, 255, 0).astype(np.uint8)
+        return rgba_to_indexed(Image.fromarray(np.dstack([lut[codes], alpha]), 'RGBA'))
+
+    remap = (np.cumsum(used) - 1).astype(np.uint8)
+    tile_img = Image.fromarray(remap[codes], 'P')
+    tile_img.putpalette(lut[used].tobytes())
+    tile_img.info['transparency'] = 0
+    return tile_img
+
+# Stretch one chart's warped bands to 8 bits and merge them into the tile image
+def composite_chart(tile_img, warped):
+    with instrument.phase('stretch'):
+        reprojected_data = stretch_bands(warped)
+    with instrument.phase('merge'):
+        merge_chart(tile_img, reprojected_data, warped.shape[0])
+
+# The tile of a chart that no other chart touches: its stretched bands cleared where it has no data,
+# which is what composite_chart gives on an empty tile, without the merge and paste
+def single_chart_tile(warped):
+    with instrument.phase('stretch'):
+        reprojected_data = stretch_bands(warped)
+    with instrument.phase('merge'):
+        has_data = np.max(reprojected_data[:3], axis=0) > 0
+        rgba = np.zeros((512, 512, 4), dtype=np.uint8)
+        rgba[:, :, :3] = reprojected_data[:3].transpose(1, 2, 0)
+        if warped.shape[0] == 4 and not np.all(reprojected_data[3] == 0):
+            rgba[:, :, 3] = reprojected_data[3]
+        else:
+            rgba[:, :, 3] = 255
+        rgba[~has_data] = 0
+        return Image.fromarray(rgba, 'RGBA')
+
+# Stretch each warped band to 0-255 by its own min/max
+def stretch_bands(warped):
+    reprojected_data = np.zeros(warped.shape, dtype=np.uint8)
+    for i in range(warped.shape[0]):
+        reprojected_band = warped[i]
+        min_val = np.min(reprojected_band)
+        max_val = np.max(reprojected_band)
+            
+        if min_val != max_val:
+            reprojected_band = ((reprojected_band - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+        else:
+            reprojected_band = np.zeros_like(reprojected_band, dtype=np.uint8)
+            
+        reprojected_data[i] = reprojected_band
+        # logging.info(f"Reprojected band {i} {reprojected_band}")
+    return reprojected_data
+
+# Paste the stretched bands of a chart into the tile image where the chart has data
+def merge_chart(tile_img, reprojected_data, band_count):
+    # Check if alpha band is present and valid
+    if band_count == 4 and not np.all(reprojected_data[3] == 0):
+        reprojected_image = Image.merge("RGBA", [Image.fromarray(reprojected_data[i], 'L') for i in range(4)])
+    else:
+        # Create alpha channel based on non-zero values in RGB channels
+        alpha_channel = (np.max(reprojected_data[:3], axis=0) > 0).astype(np.uint8) * 255
+        reprojected_image = Image.merge("RGBA", [Image.fromarray(reprojected_data[i], 'L') for i in range(3)] + [Image.fromarray(alpha_channel, 'L')])
+        
+    # Create a mask to handle transparency
+    mask = Image.fromarray((np.max(reprojected_data[:3], axis=0) > 0).astype(np.uint8) * 255, 'L')
+        
+    # Merge the reprojected image with the existing tile image
+    tile_img.paste(reprojected_image, (0, 0), mask)
+
+# Save a tile image unless it is fully transparent, returns True if it was saved.
+# With an archive sink the encoded tile is queued for the parent process to write instead.
+# With encoder threads the tile is encoded and written on one of them, while the worker goes on.
+def save_tile(tile_img, tile, tiles_dir):
+    instrument.count('tiles')
+    # Check if the entire tile is transparent
+    coverage = alpha_coverage(tile_img)
+    if coverage == 'empty':
+        tile_path = os.path.join(tiles_dir, str(tile.z), str(tile.x), f"{tile.y}.{tile_extension(tile_encoding['tile_format'])}")
+        instrument.count('empty_tiles')
+        saved_tiles.append((tile, False))
+        logging.info(f"Tile {tile_path} is fully transparent.")
+        # Remove a tile left over from charts that no longer cover it
+        if archive_output:
+            pending_tiles.append((tile, None))
         else:
-            tile_img.save(tile_path)
-            logging.info(f"Saved tile: {tile_path}")
+            DirectorySink(tiles_dir, tile_encoding['tile_format']).delete(tile)
+        return False
+
+    if encoder is None:
+        tile_saved(tile, *encode_and_write(tile_img, tile, tiles_dir, coverage))
+        return True
+    future = encoder.submit(encode_and_write, tile_img, tile, tiles_dir, coverage)
+    item_encodes.append((tile, future))
+    queued_encodes.append(future)
+    # Wait for the oldest encodes if the threads fall behind
+    while len(queued_encodes) > max_queued_encodes:
+        queued_encodes.popleft().result()
+    return True
+
+# Encode a tile and write it to the tiles directory (the parent writes it with an archive sink).
+# Returns the encoded data and the seconds spent encoding and writing; runs on an encoder thread
+# if the worker has them, so it only reads the image and leaves the bookkeeping to tile_saved.
+def encode_and_write(tile_img, tile, tiles_dir, coverage):
+    started = time.perf_counter()
+    data = encode_tile(tile_img, coverage=coverage, **tile_encoding)
+    encoded = time.perf_counter()
+    if not archive_output:
+        sink = DirectorySink(tiles_dir, tile_encoding['tile_format'])
+        if lock_tiles:
+            # Locked under the format's own name, whichever name the data is written under
+            with FileLock(tile_file_path(tiles_dir, tile) + '.lock'):
+                sink.write(tile, data)
+        else:
+            sink.write(tile, data)
+    return data, encoded - started, time.perf_counter() - encoded
+
+# Account for an encoded tile in the item that rendered it (the current item if record is None)
+# and queue it for an archive sink
+def tile_saved(tile, data, encode_seconds, write_seconds, record=None):
+    phases = {'encode': encode_seconds} if archive_output else {'encode': encode_seconds, 'write': write_seconds}
+    instrument.add_to_item(record, phases, {'bytes_written': len(data)})
+    if archive_output:
+        pending_tiles.append((tile, data))
+    saved_tiles.append((tile, True))
+    logging.info(f"Saved tile: {tile_name(tile)}")
+
+# Worker for metatile mode: warp each chart once over a block of tiles (plus a buffer against
+# edge seams) and slice the result into the individual tiles
+def process_metatile(metatile_info):
+    tile_charts, zoom_level, first_tile, tiles_dir, chart_paths, buffer = metatile_info
+    min_x, max_x = min(tile.x for tile in tile_charts), max(tile.x for tile in tile_charts)
+    min_y, max_y = min(tile.y for tile in tile_charts), max(tile.y for tile in tile_charts)
+    west, _, _, north = mercantile.xy_bounds(mercantile.Tile(min_x, min_y, zoom_level))
+    _, south, east, _ = mercantile.xy_bounds(mercantile.Tile(max_x, max_y, zoom_level))
+    width, height = (max_x - min_x + 1) * 512, (max_y - min_y + 1) * 512
+    res = (east - west) / width
+    dst_transform = from_origin(west - buffer * res, north + buffer * res, res, res)
+
+    instrument.start_item()
+    hits, misses = cache_stats['hits'], cache_stats['misses']
+    if indexed_output:
+        tile_imgs = {tile: np.zeros((512, 512), dtype=np.uint16) for tile in tile_charts}
+    else:
+        tile_imgs = {tile: Image.new('RGBA', (512, 512), (0, 0, 0, 0)) for tile in tile_charts}
+    colormaps = []
+    for slot, geotiff_path in enumerate(chart_paths):
+        dataset = get_dataset(geotiff_path, chart_overview(geotiff_path, first_tile))
+        if indexed_output:
+            warped = warp_indices(dataset, dst_transform, width + 2 * buffer, height + 2 * buffer, metatile_crs)
+            colormaps.append(dataset.colormap(1))
+        else:
+            warped = warp_chart(dataset, dst_transform, width + 2 * buffer, height + 2 * buffer, metatile_crs)
+        for tile, geotiff_paths in tile_charts.items():
+            if geotiff_path in geotiff_paths:
+                row = buffer + (tile.y - min_y) * 512
+                col = buffer + (tile.x - min_x) * 512
+                if indexed_output:
+                    composite_indices(tile_imgs[tile], warped[row:row + 512, col:col + 512], slot, chart_nodata(dataset))
+                elif len(geotiff_paths) == 1:
+                    tile_imgs[tile] = single_chart_tile(warped[:, row:row + 512, col:col + 512])
+                else:
+                    composite_chart(tile_imgs[tile], warped[:, row:row + 512, col:col + 512])
+
+    for tile, tile_img in tile_imgs.items():
+        save_tile(indexed_image(tile_img, colormaps) if indexed_output else tile_img, tile, tiles_dir)
+    return worker_stats(len(chart_paths), hits, misses, f'metatile {tile_name(first_tile)}')
+
+# Group the tiles of a zoom level (mapped to their charts) into NxN metatiles for process_metatile
+def make_metatile_infos(chart_index, tiles, zoom_level, tiles_dir, metatile, buffer):
+    metatiles = {}
+    for tile, geotiff_paths in tiles.items():
+        metatiles.setdefault((tile.x // metatile, tile.y // metatile), {})[tile] = geotiff_paths
+
+    metatile_infos = []
+    for (meta_x, meta_y), tile_charts in metatiles.items():
+        used_paths = {geotiff_path for geotiff_paths in tile_charts.values() for geotiff_path in geotiff_paths}
+        # Keep the chart index order so charts are composited in the same order as process_tile
+        chart_paths = [chart['path'] for chart in chart_index if chart['path'] in used_paths]
+        first_tile = mercantile.Tile(meta_x * metatile, meta_y * metatile, zoom_level)
+        metatile_infos.append((tile_charts, zoom_level, first_tile, tiles_dir, chart_paths, buffer))
+    return metatile_infos
+
+# Path of a tile in the {z}/{x}/{y}.png layout with the tile format's own extension, creating its
+# column directory. A tile is locked under this name even if its data goes under another.
+def tile_file_path(tiles_dir, tile):
+    tile_dir = os.path.join(tiles_dir, str(tile.z), str(tile.x))
+    os.makedirs(tile_dir, exist_ok=True)
+    return os.path.join(tile_dir, f"{tile.y}.{tile_extension(tile_encoding['tile_format'])}")
+
+# Build a parent tile by merging its four children and downsampling with the given PIL filter.
+# Missing (fully transparent) children are passed as None; returns None if all four are missing.
+def merge_children(child_imgs, resampling):
+    if all(child_img is None for child_img in child_imgs):
+        return None
+    with instrument.phase('merge_children'):
+        return downsample_children(child_imgs, resampling)
+
+def downsample_children(child_imgs, resampling):
+    size = next(child_img for child_img in child_imgs if child_img is not None).size[0]
+    merged = Image.new('RGBA', (size * 2, size * 2), (0, 0, 0, 0))
+    # Children in mercantile.children order: top-left, top-right, bottom-right, bottom-left
+    for child_img, offset in zip(child_imgs, [(0, 0), (size, 0), (size, size), (0, size)]):
+        if child_img is not None:
+            merged.paste(child_img.convert('RGBA'), offset)
+    merged = merged.resize((size, size), pyramid_resampling[resampling])
+    # Palette children each have their own palette, so the parent gets one built from its colours
+    return rgba_to_indexed(merged) if indexed_output else merged
+
+# Render a tile and everything under it down to the max zoom, keeping children in memory.
+# leaves maps each max-zoom tile to the charts that touch it; needed holds every tile with leaves under it.
+def render_pyramid(tile, leaves, needed, tiles_dir, resampling):
+    if tile in leaves:
+        tile_img = render_tile(leaves[tile], tile)
+    else:
+        child_imgs = [render_pyramid(child, leaves, needed, tiles_dir, resampling) if child in needed else None
+                      for child in mercantile.children(tile)]
+        tile_img = merge_children(child_imgs, resampling)
+        if tile_img is None:
+            # Nothing left under this tile; saving it blank removes any stale tile
+            save_tile(Image.new('RGBA', (512, 512), (0, 0, 0, 0)), tile, tiles_dir)
+            return None
+
+    return tile_img if save_tile(tile_img, tile, tiles_dir) else None
+
+# Worker for pyramid mode: render the whole subtree under one root tile
+def process_pyramid(pyramid_info):
+    leaves, zoom_level, root, tiles_dir, resampling = pyramid_info
+    needed = {root}
+    for leaf in leaves:
+        tile = leaf
+        while tile.z > root.z and tile not in needed:
+            needed.add(tile)
+            tile = mercantile.parent(tile)
+
+    instrument.start_item()
+    hits, misses = cache_stats['hits'], cache_stats['misses']
+    render_pyramid(root, leaves, needed, tiles_dir, resampling)
+    warps = sum(len(geotiff_paths) for geotiff_paths in leaves.values())
+    return worker_stats(warps, hits, misses, f'pyramid {tile_name(root)}')
+
+# Worker for pyramid levels above the split zoom: build a parent from its children's tiles.
+# With an archive sink the parent process reads the children and sends their encoded data along.
+def process_parent_tile(tile_info):
+    child_data, zoom_level, tile, tiles_dir, resampling = tile_info
+    instrument.start_item()
+    child_imgs = []
+    with instrument.phase('read_children'):
+        if child_data is None:
+            sink = DirectorySink(tiles_dir, tile_encoding['tile_format'])
+            child_data = [sink.read(child) for child in mercantile.children(tile)]
+        for data in child_data:
+            child_imgs.append(Image.open(io.BytesIO(data)).convert('RGBA') if data else None)
+
+    # A parent with no children left is saved blank, which removes any stale tile
+    tile_img = merge_children(child_imgs, resampling) or Image.new('RGBA', (512, 512), (0, 0, 0, 0))
+    save_tile(tile_img, tile, tiles_dir)
+    return worker_stats(0, 0, 0, tile_name(tile))
+
+# The tile containing the given tile at a lower (or the same) zoom level
+def ancestor(tile, zoom_level):
+    return tile if tile.z == zoom_level else mercantile.parent(tile, zoom=zoom_level)
+
+# Get the tiles that intersect the chart bounds (and any extra bounds) at a zoom level, without duplicates
+def enumerate_tiles(chart_index, zoom_level, extra_bounds=()):
+    tiles = []
+    processed_tiles = set()
+    for geo_bounds_latlon in [chart['bounds'] for chart in chart_index] + list(extra_bounds):
+        # geo_bounds_latlon are the GeoTIFF bounds in EPSG:4326
+
+        for tile in mercantile.tiles(
+            float(Decimal(geo_bounds_latlon[0])),
+            float(Decimal(geo_bounds_latlon[1])),
+            float(Decimal(geo_bounds_latlon[2])),
+            float(Decimal(geo_bounds_latlon[3])),
+            zoom_level
+        ):
+            tile_id = (tile.z, tile.x, tile.y)
+            if tile_id not in processed_tiles:
+                tiles.append(tile)
+                processed_tiles.add(tile_id)
+    return tiles
+
+# Pyramid mode: warp only the max zoom from the charts and build each lower zoom from the level below.
+# Subtrees are rendered whole on a worker so children stay in memory; the split zoom is the lowest
+# zoom with enough subtrees to keep every worker busy, and zooms above it are built from the tiles.
+# A shard owns whole subtrees from the lowest zoom with at least eight per shard (the shard zoom)
+# and renders them the same way; the zooms above the shard zoom need every shard's tiles, so
+# merge_shards.py builds them. Returns the tiles the shard owns at each zoom with the zoom's total
+# (None for the zooms left to the merge), and the tiles it saved.
+def create_pyramid_tiles(chart_index, zoom_level_start, zoom_level_end, tiles_dir, options, sink, plan=None):
+    plan = plan or {}
+    # Only the max zoom is warped, but tiles outside the charts are skipped (and removed) at every zoom
+    coverage = {}
+    for zoom_level in range(zoom_level_start, zoom_level_end + 1):
+        covered, outside, inside = classify_tiles(chart_index, enumerate_tiles(chart_index, zoom_level, plan.get('removed_bounds', ())))
+        report_coverage(f'Zoom level {zoom_level}', covered, outside, inside)
+        remove_outside_tiles(outside, sink, plan.get('dirty'))
+        coverage[zoom_level] = covered
+    leaf_tiles = coverage[zoom_level_end]
+
+    shard_zoom = zoom_level_start
+    shard_record = {}
+    if options['shard']:
+        # Deal whole subtrees to the shards, weighted by the warps of their leaves
+        index, count = (int(part) for part in options['shard'].split('/'))
+        shard_zoom = next((zoom_level for zoom_level in range(zoom_level_start, zoom_level_end + 1)
+                           if len({ancestor(tile, zoom_level) for tile in leaf_tiles}) >= 8 * count), zoom_level_end)
+        weights = {mercantile.quadkey(ancestor(tile, shard_zoom)): 0
+                   for zoom_level in range(shard_zoom, zoom_level_end + 1) for tile in coverage[zoom_level]}
+        for tile, geotiff_paths in leaf_tiles.items():
+            weights[mercantile.quadkey(ancestor(tile, shard_zoom))] += len(geotiff_paths)
+        owners = assign_groups(weights, count)
+        leaf_tiles = {tile: geotiff_paths for tile, geotiff_paths in leaf_tiles.items()
+                      if owners[mercantile.quadkey(ancestor(tile, shard_zoom))] == index}
+        for zoom_level, covered in coverage.items():
+            if zoom_level < shard_zoom:
+                shard_record[zoom_level] = (None, len(covered))
+            else:
+                shard_record[zoom_level] = ([tile for tile in covered if owners[mercantile.quadkey(ancestor(tile, shard_zoom))] == index], len(covered))
+        owned = sum(1 for owner in owners.values() if owner == index)
+        print(f"Shard {options['shard']}: {owned} of {len(owners)} subtrees at zoom level {shard_zoom}")
+        if shard_zoom > zoom_level_start:
+            print(f"Zoom level{'s' if shard_zoom - 1 > zoom_level_start else ''} {zoom_level_start}{f'-{shard_zoom - 1}' if shard_zoom - 1 > zoom_level_start else ''} left to merge_shards.py")
+
+    split_zoom = shard_zoom
+    for zoom_level in range(shard_zoom, zoom_level_end + 1):
+        if len({ancestor(tile, zoom_level) for tile in leaf_tiles}) >= 4 * cpu_count():
+            split_zoom = zoom_level
+            break
+
+    subtrees = {}
+    for tile, geotiff_paths in leaf_tiles.items():
+        subtrees.setdefault(ancestor(tile, split_zoom), {})[tile] = geotiff_paths
+    # A subtree is rendered whole if any of its leaves is under a changed chart
+    subtrees = {root: leaves for root, leaves in subtrees.items() if any(is_dirty(tile, plan.get('dirty')) for tile in leaves)}
+    pyramid_infos = [(leaves, split_zoom, root, tiles_dir, options['resampling']) for root, leaves in subtrees.items()
+                     if not rendered_since(root, sink, plan.get('started'))]
+    leaf_count = sum(len(pyramid_info[0]) for pyramid_info in pyramid_infos)
+    saved = {}
+    run_tiles(pyramid_infos, len(chart_index) * leaf_count, f'Processing zoom levels {split_zoom}-{zoom_level_end}', options, process_pyramid, sink, saved)
+    build_parent_zooms(subtrees, shard_zoom, tiles_dir, options, sink, saved)
+    return shard_record, saved
+
+# Build the zoom levels above some tiles, down to zoom_level_start, each from the tiles of the
+# level below: the parents of the tiles, then their parents, and so on
+def build_parent_zooms(tiles, zoom_level_start, tiles_dir, options, sink, saved=None):
+    parents = set(tiles)
+    if not parents:
+        return
+    for zoom_level in range(next(iter(parents)).z - 1, zoom_level_start - 1, -1):
+        parents = {mercantile.parent(tile) for tile in parents}
+        parent_infos = [(None if sink.workers_write else [sink.read(child) for child in mercantile.children(tile)], zoom_level, tile, tiles_dir, options['resampling'])
+                        for tile in parents]
+        run_tiles(parent_infos, 0, f'Processing zoom level {zoom_level}', options, process_parent_tile, sink, saved)
+
+# True if a tile is inside the region that needs rendering (None means everything does)
+def is_dirty(tile, dirty):
+    return dirty is None or dirty.intersects(box(*mercantile.bounds(tile)))
+
+# Lat/lon bounds covering all the charts
+def chart_bounds(chart_index):
+    if not chart_index:
+        return None
+    return (min(chart['bounds'][0] for chart in chart_index), min(chart['bounds'][1] for chart in chart_index),
+            max(chart['bounds'][2] for chart in chart_index), max(chart['bounds'][3] for chart in chart_index))
+
+# True if a tile was written after the given time, i.e. by an interrupted run being resumed
+def rendered_since(tile, sink, started):
+    return started is not None and sink.written_since(tile, started)
+
+# Compare the charts against the tiles manifest for some zoom levels. Returns the region covered
+# by charts that changed, were added or were removed (None if everything must be rendered) and the
+# old bounds of removed charts, whose tiles aren't enumerated from the current charts.
+def dirty_region(chart_index, charts, tiles_manifest, zoom_levels, params):
+    regions = []
+    removed_bounds = []
+    for zoom_level in zoom_levels:
+        record = tiles_manifest.get('zooms', {}).get(str(zoom_level))
+        if record is None or record.get('params') != params:
+            return None, []
+
+        previous = record['charts']
+        for chart in chart_index:
+            name = os.path.basename(chart['path'])
+            if name not in previous or previous[name]['sha256'] != charts[name]['sha256']:
+                regions.append(chart['footprint'])
+                if name in previous:
+                    regions.append(box(*previous[name]['bounds']))
+        for name, previous_chart in previous.items():
+            if name not in charts:
+                regions.append(box(*previous_chart['bounds']))
+                removed_bounds.append(tuple(previous_chart['bounds']))
+    return (unary_union(regions) if regions else GeometryCollection()), removed_bounds
+
+# Plan an incremental run over some zoom levels against the manifest in the tiles directory.
+# Returns None if nothing changed, otherwise the dirty region, the bounds of removed charts and
+# the start time of the run (or of the interrupted run being resumed).
+def plan_zoom_levels(chart_index, charts, tiles_manifest, zoom_levels, params, force):
+    if force:
+        dirty, removed_bounds = None, []
+    else:
+        dirty, removed_bounds = dirty_region(chart_index, charts, tiles_manifest, zoom_levels, params)
+        if dirty is not None and dirty.is_empty:
+            return None
+
+    target = {'zooms': list(zoom_levels), 'charts': charts, 'params': params}
+    in_progress = tiles_manifest.get('in_progress')
+    if in_progress and all(in_progress.get(key) == value for key, value in target.items()):
+        started = in_progress['started']
+        print(f"Resuming the interrupted run of zoom levels {zoom_levels[0]}-{zoom_levels[-1]}")
+    else:
+        started = time.time()
+    tiles_manifest['in_progress'] = {**target, 'started': started}
+    return {'dirty': dirty, 'removed_bounds': removed_bounds, 'started': started}
+
+# Record zoom levels as rendered from the given charts once they are complete
+def complete_zoom_levels(tiles_manifest, charts, zoom_levels, params):
+    for zoom_level in zoom_levels:
+        tiles_manifest.setdefault('zooms', {})[str(zoom_level)] = {'charts': charts, 'params': params}
+    tiles_manifest.pop('in_progress', None)
 
 # Function to regenerate specific tiles or columns
-def regenerate_tiles(geotiff_paths, zoom_level, tile_x, tile_y, tiles_dir):
-    tile_infos = []
+def regenerate_tiles(geotiff_paths, zoom_level, tile_x, tile_y, tiles_dir, options=None):
+    options = {**default_options, **(options or {})}
+    chart_index = build_chart_index(geotiff_paths, cutlines=options['cutlines'], keep_palette=options['indexed'])
+    if options['indexed'] and not check_indexed_charts(chart_index):
+        return
     if tile_y is not None:
         # Regenerate specific tile
-        tile = mercantile.Tile(x=tile_x, y=tile_y, z=zoom_level)
-        tile_infos.append((geotiff_paths, zoom_level, tile, tiles_dir))
+        tiles = [mercantile.Tile(x=tile_x, y=tile_y, z=zoom_level)]
     else:
         # Regenerate entire column
-        for tile_y in range(0, 2**zoom_level):
-            tile = mercantile.Tile(x=tile_x, y=tile_y, z=zoom_level)
-            tile_infos.append((geotiff_paths, zoom_level, tile, tiles_dir))
+        tiles = [mercantile.Tile(x=tile_x, y=tile_y, z=zoom_level) for tile_y in range(0, 2**zoom_level)]
+    covered, outside, inside = classify_tiles(chart_index, tiles)
+    report_coverage(f'Zoom level {zoom_level}, column {tile_x}', covered, outside, inside)
+    tile_infos = [(geotiff_paths, zoom_level, tile, tiles_dir) for tile, geotiff_paths in covered.items()]
     
     # Use multiprocessing to process tiles in parallel
-    with Pool(cpu_count()) as pool:
-        for _ in tqdm(pool.imap_unordered(process_tile, tile_infos), total=len(tile_infos), desc=f'Regenerating tiles at zoom level {zoom_level}, column {tile_x}'):
-            pass
+    sink = open_sink(options['sink'], tiles_dir, options['tile_format'])
+    start_run_report(options)
+    try:
+        remove_outside_tiles(outside, sink)
+        run_tiles(tile_infos, len(geotiff_paths) * len(tile_infos), f'Regenerating tiles at zoom level {zoom_level}, column {tile_x}', options, sink=sink)
+    finally:
+        sink.close(chart_bounds(chart_index))
+        finish_run_report()
 
 # Read the GeoTIFF file and create slippy tiles
-def create_slippy_tiles(geotiff_paths, zoom_level_start, zoom_level_end, tiles_dir):
-    for zoom_level in range(zoom_level_start, zoom_level_end + 1):
-        tile_infos = []
-        processed_tiles = set()
-        
-        for geotiff_path in geotiff_paths:
-            with rasterio.open(geotiff_path) as dataset:
-                # Get the bounds of the dataset
-                bounds = dataset.bounds
-                # Transform the GeoTIFF bounds to EPSG:4326
-                geo_bounds_latlon = transform_bounds(dataset.crs, target_crs, *bounds)
-                
-                # Get the tiles that intersect with the GeoTIFF bounds at the specified zoom level
-                tiles = list(mercantile.tiles(
-                    float(Decimal(geo_bounds_latlon[0])),
-                    float(Decimal(geo_bounds_latlon[1])),
-                    float(Decimal(geo_bounds_latlon[2])),
-                    float(Decimal(geo_bounds_latlon[3])),
-                    zoom_level
-                ))
-                for tile in tiles:
-                    tile_id = (tile.z, tile.x, tile.y)
-                    if tile_id not in processed_tiles:
-                        tile_infos.append((geotiff_paths, zoom_level, tile, tiles_dir))
-                        processed_tiles.add(tile_id)
-        
-        # Use multiprocessing to process tiles in parallel
-        with Pool(cpu_count()) as pool:
-            for _ in tqdm(pool.imap_unordered(process_tile, tile_infos), total=len(tile_infos), desc=f'Processing zoom level {zoom_level}'):
-                pass
+def create_slippy_tiles(geotiff_paths, zoom_level_start, zoom_level_end, tiles_dir, options=None):
+    options = {**default_options, **(options or {})}
+    # Index the chart footprints once for all zoom levels
+    chart_index = build_chart_index(geotiff_paths, cutlines=options['cutlines'], keep_palette=options['indexed'])
+    if options['indexed'] and not check_indexed_charts(chart_index):
+        return
+
+    # Fingerprint the charts against the manifest of the previous run
+    metadata = load_metadata(tiles_dir)
+    tiles_manifest = stage_manifest(metadata, 'tiles')
+    previous_fingerprints = tiles_manifest.get('fingerprints', {})
+    fingerprints = tiles_manifest['fingerprints'] = {}
+    charts = {}
+    for chart in chart_index:
+        name = os.path.basename(chart['path'])
+        fingerprints[name] = file_fingerprint(chart['path'], previous_fingerprints.get(name))
+        charts[name] = {'sha256': fingerprints[name]['sha256'], 'bounds': list(chart['bounds'])}
+        # A raw chart clipped on the fly also changes when its shapefile does
+        if options['cutlines']:
+            shapefile_path = options['cutlines'][chart['path']]
+            shapefile_name = os.path.basename(shapefile_path)
+            fingerprints[shapefile_name] = file_fingerprint(shapefile_path, previous_fingerprints.get(shapefile_name))
+            charts[name]['sha256'] += ':' + fingerprints[shapefile_name]['sha256']
+    params = {key: options[key] for key in output_options}
+
+    sink = open_sink(options['sink'], tiles_dir, options['tile_format'])
+    start_run_report(options)
+    try:
+        if options['pyramid']:
+            zoom_levels = list(range(zoom_level_start, zoom_level_end + 1))
+            plan = plan_zoom_levels(chart_index, charts, tiles_manifest, zoom_levels, params, options['force'])
+            if plan is None:
+                print(f'Zoom levels {zoom_level_start}-{zoom_level_end}: charts unchanged since the last run, skipped')
+                return
+            save_metadata(tiles_dir, metadata)
+            shard_record, saved = create_pyramid_tiles(chart_index, zoom_level_start, zoom_level_end, tiles_dir, options, sink, plan)
+            for zoom_level, (assigned, total) in shard_record.items():
+                record_shard(tiles_manifest, options['shard'], zoom_level, assigned, total, {tile: was_saved for tile, was_saved in saved.items() if tile.z == zoom_level})
+            complete_zoom_levels(tiles_manifest, charts, zoom_levels, params)
+            save_metadata(tiles_dir, metadata)
+            return
+
+        for zoom_level in range(zoom_level_start, zoom_level_end + 1):
+            plan = plan_zoom_levels(chart_index, charts, tiles_manifest, [zoom_level], params, options['force'])
+            if plan is None:
+                print(f'Zoom level {zoom_level}: charts unchanged since the last run, skipped')
+                continue
+            save_metadata(tiles_dir, metadata)
+
+            # Skip the tiles outside every chart, removing any an earlier run left there
+            covered, outside, inside = classify_tiles(chart_index, enumerate_tiles(chart_index, zoom_level, plan['removed_bounds']))
+            report_coverage(f'Zoom level {zoom_level}', covered, outside, inside)
+            remove_outside_tiles(outside, sink, plan['dirty'])
+            total = len(covered)
+            if options['shard']:
+                covered = shard_tiles(covered, options['shard'])
+                print(f"Shard {options['shard']}: {len(covered)} of {total} tiles")
+
+            # Tiles under changed charts that an interrupted run hasn't already rendered
+            tiles = {tile: geotiff_paths for tile, geotiff_paths in covered.items()
+                     if is_dirty(tile, plan['dirty']) and not rendered_since(tile, sink, plan['started'])}
+
+            saved = {}
+            if options['metatile'] > 1:
+                metatile_infos = make_metatile_infos(chart_index, tiles, zoom_level, tiles_dir, options['metatile'], options['metatile_buffer'])
+                run_tiles(metatile_infos, len(geotiff_paths) * len(tiles), f'Processing zoom level {zoom_level}', options, process_metatile, sink, saved)
+            else:
+                # Only send each tile the charts that actually touch it
+                tile_infos = [(geotiff_paths, zoom_level, tile, tiles_dir) for tile, geotiff_paths in tiles.items()]
+
+                # Use multiprocessing to process tiles in parallel
+                run_tiles(tile_infos, len(geotiff_paths) * len(tile_infos), f'Processing zoom level {zoom_level}', options, sink=sink, saved=saved)
+
+            if options['shard']:
+                record_shard(tiles_manifest, options['shard'], zoom_level, covered, total, saved)
+            complete_zoom_levels(tiles_manifest, charts, [zoom_level], params)
+            save_metadata(tiles_dir, metadata)
+    finally:
+        # Archive sinks are only complete once closed
+        sink.close(chart_bounds(chart_index))
+        finish_run_report()
+
+# Add the zoom range and tile rendering options to an argument parser
+def add_tile_arguments(parser):
+    parser.add_argument('--start_zoom', type=int, default=8, help='Start zoom level (default: 8)')
+    parser.add_argument('--end_zoom', type=int, default=11, help='End zoom level (default: 11)')
+    parser.add_argument('--dataset_cache_size', type=int, default=default_options['dataset_cache_size'], help=f"Open datasets kept per worker (default: {default_options['dataset_cache_size']})")
+    parser.add_argument('--gdal_cache_mb', type=int, default=default_options['gdal_cache_mb'], help=f"GDAL block cache size per worker in MB (default: {default_options['gdal_cache_mb']})")
+    parser.add_argument('--chunk_size', type=int, default=default_options['chunk_size'], help='Tiles handed to a worker at a time (default: picked from the number of tiles)')
+    parser.add_argument('--pyramid', action='store_true', help='Warp only the end zoom from the GeoTIFFs and build lower zooms by downsampling the tiles below')
+    parser.add_argument('--resampling', type=str, default=default_options['resampling'], choices=sorted(pyramid_resampling), help=f"Filter used to downsample tiles in pyramid mode (default: {default_options['resampling']})")
+    parser.add_argument('--metatile', type=int, default=default_options['metatile'], help='Warp NxN blocks of tiles in one pass, e.g. 8 (default: 1, one tile at a time)')
+    parser.add_argument('--metatile_buffer', type=int, default=default_options['metatile_buffer'], help=f"Pixels warped around each metatile to avoid edge seams (default: {default_options['metatile_buffer']})")
+    parser.add_argument('--force', action='store_true', help='Render every tile, even if the charts under it are unchanged since the last run')
+    parser.add_argument('--sink', type=str, default=default_options['sink'], choices=sink_kinds, help=f"Where to write the tiles: a {{z}}/{{x}}/{{y}}.png directory tree, or a single tiles.mbtiles or tiles.pmtiles archive in the output directory (default: {default_options['sink']})")
+    parser.add_argument('--indexed', action='store_true', help='Warp paletted charts (extracted with --keep_palette) as palette indices and write 8-bit palette PNG tiles')
+    parser.add_argument('--indexed_resampling', type=str, default=default_options['indexed_resampling'], choices=sorted(index_resampling), help=f"How palette indices are resampled in indexed mode (default: {default_options['indexed_resampling']})")
+    parser.add_argument('--tile_format', type=str, default=default_options['tile_format'], choices=list(tile_formats), help="Tile encoding: png, png8 (8-bit palette), webp (lossless), webp_lossy, or jpeg (opaque tiles as .jpg JPEG, the rest as .png PNG; --sink dir only) (default: png)")
+    parser.add_argument('--png_level', type=int, default=default_options['png_level'], choices=range(10), metavar='0-9', help=f"zlib compression level of PNG tiles, lower is faster and larger (default: {default_options['png_level']})")
+    parser.add_argument('--quality', type=int, default=default_options['quality'], help=f"Quality of webp_lossy and jpeg tiles, 1-100 (default: {default_options['quality']})")
+    parser.add_argument('--encode_threads', type=int, default=default_options['encode_threads'], help=f"Threads per worker that encode and write tiles while the worker renders the next, 0 to encode inline (default: {default_options['encode_threads']})")
+    parser.add_argument('--shard', type=shard_spec, default=None, help='Render only shard i (counting from 0) of N disjoint shares of the tiles, given as i/N; combine the shards with merge_shards.py')
+    parser.add_argument('--lock_tiles', action='store_true', help='Lock each tile file while writing it, for several runs writing the same output directory at once')
+    parser.add_argument('--report', type=str, default=None, help='Time each phase of each tile and write a JSON run report to this path, with a CSV of the tiles next to it')
+    parser.add_argument('--profile_slowest', type=int, default=0, help='With --report, also save cProfile dumps of the N slowest tiles (default: 0)')
+
+# Build the options dict for create_slippy_tiles from parsed arguments
+def tile_options(args):
+    return {
+        'dataset_cache_size': args.dataset_cache_size,
+        'gdal_cache_mb': args.gdal_cache_mb,
+        'chunk_size': args.chunk_size,
+        'pyramid': args.pyramid,
+        'resampling': args.resampling,
+        'metatile': args.metatile,
+        'metatile_buffer': args.metatile_buffer,
+        'force': args.force,
+        'sink': args.sink,
+        'indexed': args.indexed,
+        'indexed_resampling': args.indexed_resampling,
+        'report': args.report,
+        'profile_slowest': args.profile_slowest,
+        'lock_tiles': args.lock_tiles,
+        'shard': args.shard,
+        'tile_format': args.tile_format,
+        'png_level': args.png_level,
+        'quality': args.quality,
+        'encode_threads': args.encode_threads,
+    }
+
+# Reject combinations of the tile arguments that can't work together
+def check_tile_arguments(parser, args):
+    if args.pyramid and args.metatile > 1:
+        parser.error('--metatile cannot be combined with --pyramid, which renders one tile at a time')
+    if args.tile_format == 'jpeg' and args.sink != 'dir':
+        parser.error('--tile_format jpeg writes PNG for tiles with transparent pixels, so it needs --sink dir')
 
 # Main function
 def main():
+    # Setup logging
+    logging.basicConfig(filename='tiles.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
     # Argument parser setup
     parser = argparse.ArgumentParser(description='Generate or regenerate slippy tiles from GeoTIFF files.')
-    parser.add_argument('--start_zoom', type=int, default=8, help='Start zoom level (default: 8)')
-    parser.add_argument('--end_zoom', type=int, default=11, help='End zoom level (default: 11)')
     parser.add_argument('--input_dir', type=str, default='./reprojected', help='Input directory containing GeoTIFF files (default: ./reprojected)')
     parser.add_argument('--output_dir', type=str, default='./tiles', help='Output directory for generated tiles (default: ./tiles)')
     parser.add_argument('--zoom', type=int, help='Zoom level for regeneration')
     parser.add_argument('--tile_x', type=int, help='Tile column for regeneration')
     parser.add_argument('--tile_y', type=int, help='Tile row for regeneration (optional)')
+    add_tile_arguments(parser)
     args = parser.parse_args()
+    check_tile_arguments(parser, args)
+    if args.shard and args.zoom is not None and args.tile_x is not None:
+        parser.error('--shard splits whole builds; regenerate tiles in the merged output instead')
+    options = tile_options(args)
 
     # Ensure output directory exists
     os.makedirs(args.output_dir, exist_ok=True)
@@ -171,16 +1186,19 @@ def main():
     
     if args.zoom is not None and args.tile_x is not None:
         # Regenerate specific tiles or columns
-        regenerate_tiles(geotiff_paths, args.zoom, args.tile_x, args.tile_y, args.output_dir)
+        regenerate_tiles(geotiff_paths, args.zoom, args.tile_x, args.tile_y, args.output_dir, options)
     else:
         # Create slippy tiles
-        create_slippy_tiles(geotiff_paths, args.start_zoom, args.end_zoom, args.output_dir)
+        create_slippy_tiles(geotiff_paths, args.start_zoom, args.end_zoom, args.output_dir, options)
         print("Slippy tiles created.")
     
-    # Copy JSON file from input directory to output directory
-    json_file = os.path.join(args.input_dir, 'update_metadata.json')
-    if os.path.exists(json_file):
-        shutil.copy(json_file, args.output_dir)
+    # Write the input JSON metadata to the output directory, keeping the tiles manifest
+    input_metadata = load_metadata(args.input_dir)
+    tiles_manifest = stage_manifest(load_metadata(args.output_dir), 'tiles')
+    update_metadata = dict(input_metadata)
+    update_metadata['manifest'] = {**input_metadata.get('manifest', {}), 'tiles': tiles_manifest}
+    save_metadata(args.output_dir, update_metadata)
+    if input_metadata:
         print("JSON metadata file copied to the output directory.")
     else:
         print("JSON metadata file not found in the input directory.")
@@ -0,0 +1,67 @@
+import os
+import argparse
+import logging
+from make_slippy_tile import create_slippy_tiles, add_tile_arguments, check_tile_arguments, tile_options
+from extract_sectional_charts import get_latest_date_from_html
+from manifest import load_metadata, save_metadata, stage_manifest
+
+# Fused pipeline: renders tiles straight from the raw charts. Each chart is cropped (and
+# palette-expanded) through a VRT as it is read, and the tile warp clips it to its shapefile while it
+# reprojects it, so no clipped or reprojected GeoTIFF is written. The three separate scripts still
+# work for debugging.
+
+# Find the raw charts that have a shapefile, mapped to it
+def find_raw_charts(source_dir, shapefile_dir):
+    cutlines = {}
+    for filename in os.listdir(source_dir):
+        if not filename.endswith('.tif'):
+            continue
+        raster_path = os.path.join(source_dir, filename)
+        shapefile_path = os.path.join(shapefile_dir, filename.replace('.tif', '.shp'))
+        if os.path.exists(shapefile_path):
+            cutlines[raster_path] = shapefile_path
+        else:
+            logging.warning(f'Shapefile not found for {raster_path}')
+    return cutlines
+
+def main():
+    # Setup logging
+    logging.basicConfig(filename='pipeline.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description='Generate slippy tiles directly from the raw sectional chart GeoTIFFs.')
+    parser.add_argument('--source_dir', type=str, default='./rawtiff', help='Source directory containing the raw GeoTIFF and .htm files (default: ./rawtiff)')
+    parser.add_argument('--shapefile_dir', type=str, default='./shapefiles/', help='Directory containing the clip shapefiles (default: ./shapefiles/)')
+    parser.add_argument('--output_dir', type=str, default='./tiles', help='Output directory for generated tiles (default: ./tiles)')
+    add_tile_arguments(parser)
+    args = parser.parse_args()
+    check_tile_arguments(parser, args)
+
+    # Ensure output directory exists
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    cutlines = find_raw_charts(args.source_dir, args.shapefile_dir)
+    if not cutlines:
+        print(f"No GeoTIFF files with shapefiles found in the '{args.source_dir}' directory.")
+        return
+
+    options = tile_options(args)
+    options['cutlines'] = cutlines
+    create_slippy_tiles(list(cutlines), args.start_zoom, args.end_zoom, args.output_dir, options)
+    print("Slippy tiles created.")
+
+    # Write the chart metadata the extract step would have, keeping the tiles manifest
+    update_metadata = {'maps': []}
+    latest_file, latest_date = get_latest_date_from_html(args.source_dir)
+    if latest_file:
+        update_metadata['last_updated'] = latest_date.isoformat() + 'Z'
+        update_metadata['maps'] = [{'name': os.path.basename(raster_path).replace('.tif', ''), 'last_updated': update_metadata['last_updated']}
+                                   for raster_path in cutlines]
+    else:
+        logging.error('No HTML files with valid dates found in the input folder.')
+        print('No HTML files with valid dates found in the input folder.')
+    update_metadata['manifest'] = {'tiles': stage_manifest(load_metadata(args.output_dir), 'tiles')}
+    save_metadata(args.output_dir, update_metadata)
+
+if __name__ == '__main__':
+    main()
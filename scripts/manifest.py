@@ -0,0 +1,58 @@
+import os
+import json
+import hashlib
+
+# Helpers for the per-stage manifests kept in update_metadata.json. Each stage records a
+# fingerprint of its inputs and the parameters it ran with, so unchanged outputs can be skipped
+# on the next chart cycle and an interrupted run can pick up where it stopped.
+
+metadata_filename = 'update_metadata.json'
+
+# Load update_metadata.json from a directory, or an empty dict if there isn't one
+def load_metadata(directory):
+    metadata_path = os.path.join(directory, metadata_filename)
+    if not os.path.exists(metadata_path):
+        return {}
+    try:
+        with open(metadata_path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+# Write update_metadata.json atomically so an interrupted run never leaves a truncated manifest
+def save_metadata(directory, metadata):
+    metadata_path = os.path.join(directory, metadata_filename)
+    tmp_path = metadata_path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(metadata, json_file, indent=4)
+    os.replace(tmp_path, metadata_path)
+
+# Get the manifest section for a stage, creating it if needed
+def stage_manifest(metadata, stage):
+    return metadata.setdefault('manifest', {}).setdefault(stage, {})
+
+# Fingerprint a file by content hash. The hash from the previous fingerprint is reused when
+# the size and modification time haven't changed, so unchanged charts aren't read again.
+def file_fingerprint(path, previous=None):
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return previous
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return {'sha256': sha256.hexdigest(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# True if two fingerprints have the same content
+def same_content(fingerprint, other):
+    return bool(fingerprint and other) and fingerprint.get('sha256') == other.get('sha256')
+
+# True if an output was produced from the same inputs and parameters and is still on disk
+def is_up_to_date(previous_entry, inputs, params, output_path):
+    if not previous_entry or not os.path.exists(output_path):
+        return False
+    if previous_entry.get('params') != params:
+        return False
+    previous_inputs = previous_entry.get('inputs', {})
+    return previous_inputs.keys() == inputs.keys() and all(same_content(inputs[key], previous_inputs[key]) for key in inputs)
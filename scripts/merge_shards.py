@@ -0,0 +1,221 @@
+import os
+import sys
+import argparse
+import logging
+import mercantile
+from tqdm import tqdm
+from tile_sinks import open_sink, open_reader, sink_kinds
+from manifest import load_metadata, save_metadata, stage_manifest
+from make_slippy_tile import build_parent_zooms, default_options, output_options
+
+# Merge the outputs of make_slippy_tile.py runs with --shard i/N into one tile set. Each shard
+# records the tiles it owns in its tiles manifest; the shards are checked to be the N disjoint
+# shares of one build before their tiles are copied, and every tile a shard owns must be in its
+# output unless the shard found it empty. The low zooms of a --pyramid build need every shard's
+# tiles, so they are built here from the merged zoom below.
+
+# Load the tiles manifest of each shard directory, keyed by shard index. Returns the manifests and
+# a list of problems that make the set of shards unusable.
+def load_shards(shard_dirs):
+    shards = {}
+    problems = []
+    counts = set()
+    for shard_dir in shard_dirs:
+        tiles_manifest = stage_manifest(load_metadata(shard_dir), 'tiles')
+        record = tiles_manifest.get('shard')
+        if not record:
+            problems.append(f'{shard_dir}: not the output of a --shard run')
+            continue
+        index, count = (int(part) for part in record['spec'].split('/'))
+        counts.add(count)
+        if index in shards:
+            problems.append(f"{shard_dir}: shard {record['spec']} is also in {shards[index]['dir']}")
+            continue
+        if tiles_manifest.get('in_progress'):
+            problems.append(f"{shard_dir}: shard {record['spec']} was interrupted, run it again to finish it")
+        shards[index] = {'dir': shard_dir, 'manifest': tiles_manifest, 'record': record}
+
+    if len(counts) > 1:
+        problems.append(f"the shards split the tiles different ways: {', '.join(sorted(str(count) for count in counts))} shards")
+    elif counts:
+        missing = sorted(set(range(counts.pop())) - set(shards))
+        if missing:
+            problems.append(f"shards {', '.join(str(index) for index in missing)} are missing")
+    return shards, problems
+
+# Check that the shards were rendered from the same charts and options and that their tiles add up
+# to each zoom level's tiles exactly once
+def check_shards(shards):
+    problems = []
+    first = shards[min(shards)]
+    zooms = first['manifest'].get('zooms', {})
+    for index, shard in sorted(shards.items()):
+        shard_zooms = shard['manifest'].get('zooms', {})
+        if shard_zooms.keys() != zooms.keys():
+            problems.append(f"{shard['dir']}: zoom levels {', '.join(sorted(shard_zooms, key=int))} differ from {', '.join(sorted(zooms, key=int))} in {first['dir']}")
+            continue
+        for zoom_level, record in shard_zooms.items():
+            params = {key: value for key, value in record['params'].items() if key != 'shard'}
+            first_params = {key: value for key, value in zooms[zoom_level]['params'].items() if key != 'shard'}
+            if record['charts'] != zooms[zoom_level]['charts'] or params != first_params:
+                problems.append(f"{shard['dir']}: zoom level {zoom_level} was rendered from other charts or options than {first['dir']}")
+    if problems:
+        return problems
+
+    for zoom_level in sorted(zooms, key=int):
+        records = [shard['record']['zooms'].get(zoom_level) for shard in shards.values()]
+        if any(record is None for record in records):
+            problems.append(f'zoom level {zoom_level}: not every shard recorded its tiles')
+            continue
+        from_zoom_below = {bool(record.get('from_zoom_below')) for record in records}
+        if len(from_zoom_below) > 1:
+            problems.append(f'zoom level {zoom_level}: the shards disagree on whether it is built when merging')
+            continue
+        if from_zoom_below.pop():
+            continue
+        totals = {record['total'] for record in records}
+        assigned = [quadkey for record in records for quadkey in record['assigned']]
+        if len(totals) > 1:
+            problems.append(f'zoom level {zoom_level}: the shards disagree on the number of tiles')
+        elif len(set(assigned)) != len(assigned):
+            problems.append(f'zoom level {zoom_level}: {len(assigned) - len(set(assigned))} tiles are owned by more than one shard')
+        elif len(assigned) != totals.pop():
+            problems.append(f'zoom level {zoom_level}: the shards own {len(assigned)} tiles, expected {records[0]["total"]}')
+    return problems
+
+# The pyramid zoom levels that are built from the merged zoom below, highest first
+def merge_built_zooms(shards):
+    records = shards[min(shards)]['record']['zooms']
+    return sorted((zoom_level for zoom_level, record in records.items() if record.get('from_zoom_below')), key=int, reverse=True)
+
+# Copy every non-empty tile each shard owns into the output sink (or only check that it is there
+# if output_sink is None). Returns the number of tiles found and the tiles missing from their
+# shard's output, per zoom level.
+def merge_tiles(shards, output_sink=None):
+    copied = {}
+    missing = {}
+    built = set(merge_built_zooms(shards))
+    for index, shard in sorted(shards.items()):
+        zoom_levels = sorted(set(shard['record']['zooms']) - built, key=int)
+        params = shard['manifest']['zooms'][zoom_levels[0]]['params']
+        # Read-only, so checking or merging never modifies a shard
+        shard_reader = open_reader(params['sink'], shard['dir'], params.get('tile_format', 'png'))
+        try:
+            for zoom_level in zoom_levels:
+                record = shard['record']['zooms'][zoom_level]
+                empty = set(record['empty'])
+                for quadkey in tqdm(record['assigned'], desc=f"{'Merging' if output_sink else 'Checking'} shard {shard['record']['spec']}, zoom level {zoom_level}"):
+                    if quadkey in empty:
+                        continue
+                    tile = mercantile.quadkey_to_tile(quadkey)
+                    data = shard_reader.read(tile)
+                    if data is None:
+                        missing.setdefault(zoom_level, []).append(f'{tile.z}/{tile.x}/{tile.y} (shard {index})')
+                        continue
+                    if output_sink is not None:
+                        output_sink.write(tile, data)
+                    copied[zoom_level] = copied.get(zoom_level, 0) + 1
+        finally:
+            shard_reader.close()
+    return copied, missing
+
+# Build the pyramid zoom levels the shards left to the merge, each from the merged tiles of the zoom
+# below, with the resampling and tile format the shards were rendered with
+def build_merged_zooms(shards, output_dir, output_sink):
+    zoom_levels = merge_built_zooms(shards)
+    if not zoom_levels:
+        return
+    below = str(int(zoom_levels[0]) + 1)
+    params = shards[min(shards)]['manifest']['zooms'][below]['params']
+    options = {**default_options, **{key: params[key] for key in output_options if key in params}, 'shard': None}
+    tiles = [mercantile.quadkey_to_tile(quadkey) for shard in shards.values() for quadkey in shard['record']['zooms'][below]['assigned']]
+    build_parent_zooms(tiles, int(zoom_levels[-1]), output_dir, options, output_sink)
+
+# Metadata for the merged tiles: the first shard's, with the zoom levels that merged completely
+# recorded as rendered without sharding so an unsharded incremental run can continue from them
+def merged_metadata(shards, missing):
+    metadata = load_metadata(shards[min(shards)]['dir'])
+    tiles_manifest = stage_manifest(metadata, 'tiles')
+    tiles_manifest.pop('shard', None)
+    zooms = {}
+    for zoom_level, record in tiles_manifest.get('zooms', {}).items():
+        if zoom_level not in missing:
+            zooms[zoom_level] = {**record, 'params': {**record['params'], 'shard': None}}
+    tiles_manifest['zooms'] = zooms
+    return metadata
+
+# Lat/lon bounds covering the charts the shards were rendered from
+def merged_bounds(shards):
+    charts = [chart for record in shards[min(shards)]['manifest'].get('zooms', {}).values() for chart in record['charts'].values()]
+    if not charts:
+        return None
+    return (min(chart['bounds'][0] for chart in charts), min(chart['bounds'][1] for chart in charts),
+            max(chart['bounds'][2] for chart in charts), max(chart['bounds'][3] for chart in charts))
+
+def main():
+    # Setup logging
+    logging.basicConfig(filename='merging.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description='Merge the outputs of sharded make_slippy_tile.py runs into one tile set.')
+    parser.add_argument('shard_dirs', nargs='+', help='Output directories of the shards, one per shard')
+    parser.add_argument('--output_dir', type=str, default='./tiles', help='Output directory for the merged tiles (default: ./tiles)')
+    parser.add_argument('--sink', type=str, default='dir', choices=sink_kinds, help='Where to write the merged tiles: a {z}/{x}/{y}.png directory tree, or a tiles.mbtiles or tiles.pmtiles archive in the output directory (default: dir)')
+    parser.add_argument('--check', action='store_true', help='Only check that the shards are complete, without copying any tiles')
+    args = parser.parse_args()
+
+    shards, problems = load_shards(args.shard_dirs)
+    if not problems:
+        problems = check_shards(shards)
+    if problems:
+        for problem in problems:
+            logging.error(problem)
+            print(problem)
+        sys.exit(1)
+
+    if args.check:
+        copied, missing = merge_tiles(shards)
+    else:
+        params = next(iter(shards[min(shards)]['manifest']['zooms'].values()))['params']
+        if params.get('tile_format') == 'jpeg' and args.sink != 'dir':
+            parser.error('jpeg shards mix JPEG and PNG tiles, so they can only be merged with --sink dir')
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_sink = open_sink(args.sink, args.output_dir, params.get('tile_format', 'png'))
+        try:
+            copied, missing = merge_tiles(shards, output_sink)
+            if missing:
+                # The zooms built from incomplete tiles would be incomplete too
+                for zoom_level in merge_built_zooms(shards):
+                    missing.setdefault(zoom_level, [])
+            else:
+                build_merged_zooms(shards, args.output_dir, output_sink)
+        finally:
+            output_sink.close(merged_bounds(shards))
+        save_metadata(args.output_dir, merged_metadata(shards, missing))
+
+    built = merge_built_zooms(shards)
+    for zoom_level in sorted(shards[min(shards)]['record']['zooms'], key=int):
+        records = [shard['record']['zooms'][zoom_level] for shard in shards.values()]
+        if zoom_level in built:
+            status = 'not built, tiles are missing' if missing else ('built when merging' if args.check else 'built from the zoom level below')
+            message = f"Zoom level {zoom_level}: {records[0]['total']} tiles, {status}"
+            logging.info(message)
+            print(message)
+            continue
+        empty = sum(len(record['empty']) for record in records)
+        message = (f"Zoom level {zoom_level}: {records[0]['total']} tiles, {copied.get(zoom_level, 0)} {'found' if args.check else 'merged'}, "
+                   f"{empty} empty, {len(missing.get(zoom_level, []))} missing")
+        logging.info(message)
+        print(message)
+    if missing:
+        for zoom_level, tiles in sorted(missing.items(), key=lambda item: int(item[0])):
+            if not tiles:
+                continue
+            for tile in tiles:
+                logging.error(f'Missing tile {tile}')
+            print(f"Missing at zoom level {zoom_level}: {', '.join(tiles[:10])}{' ...' if len(tiles) > 10 else ''}")
+        sys.exit(1)
+    print('All shards complete.')
+
+if __name__ == '__main__':
+    main()
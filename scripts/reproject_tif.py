@@ -1,21 +1,60 @@
 import os
+import math
+import numpy as np
 import rasterio
+import rasterio.shutil
+from affine import Affine
+from rasterio.crs import CRS
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import logging
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 import argparse
-import shutil
+from manifest import load_metadata, save_metadata, stage_manifest, file_fingerprint, is_up_to_date
+from instrument import RunReport
+import instrument
+from scheduler import run_scheduled, memory_budget, format_mb, size_estimate, process_overhead, total_memory
 
-# Setup logging
-logging.basicConfig(filename='reprojecting.log', level=logging.INFO, 
-                    format='%(asctime)s %(levelname)s:%(message)s')
+# Equator length of web mercator; a zoom level's pixel size is this over (tile size * 2 ** zoom)
+web_mercator_extent = 40075016.685578488
+tile_size = 512
 
-def reproject_raster(input_path, output_path, target_crs, nodata_value=None):
+# Snap a web mercator grid to the pixel size of the coarsest tiler zoom level at least as fine as
+# the source, so the base image is never downsampled. Like the COG driver, the output gets 2x
+# overviews until it fits in one block. The origin is snapped to the tile grid of the coarsest
+# overview's zoom and the size padded to a whole number of its pixels, so each overview has
+# exactly the pixel size of a zoom and its blocks are that zoom's tiles. Returns the grid and the
+# number of overviews.
+def zoom_aligned_grid(transform, width, height):
+    # The tolerance keeps a source already at a zoom's pixel size from going one zoom finer
+    zoom = math.ceil(math.log2(web_mercator_extent / (tile_size * transform.a)) - 1e-9)
+    res = web_mercator_extent / (tile_size * 2 ** zoom)
+    east = transform.c + width * transform.a
+    south = transform.f + height * transform.e
+    size = max(east - transform.c, transform.f - south) / res
+    overview_count = min(zoom, max(0, math.ceil(math.log2(size / tile_size))))
+    factor = 2 ** overview_count
+    coarse_extent = tile_size * res * factor
+    west = math.floor((transform.c + web_mercator_extent / 2) / coarse_extent) * coarse_extent - web_mercator_extent / 2
+    north = web_mercator_extent / 2 - math.floor((web_mercator_extent / 2 - transform.f) / coarse_extent) * coarse_extent
+    width = math.ceil((east - west) / res / factor) * factor
+    height = math.ceil((north - south) / res / factor) * factor
+    return Affine(res, 0, west, 0, -res, north), width, height, overview_count
+
+# Reproject a GeoTIFF, warping all bands in one pass on num_threads threads with warp_mem_mb of
+# warp buffers. With cog, the output is a tiled, compressed Cloud-Optimized GeoTIFF with internal
+# overviews, on a grid aligned with the tiler's zoom levels when the target is web mercator.
+def reproject_raster(input_path, output_path, target_crs, nodata_value=None, cog=False, num_threads=1, warp_mem_mb=512):
+    warp_path = f'{output_path}.warp' if cog else output_path
     try:
-        with rasterio.open(input_path) as src:
+        with instrument.phase('open'), rasterio.open(input_path) as src:
             transform, width, height = calculate_default_transform(
                 src.crs, target_crs, src.width, src.height, *src.bounds)
+            cog_options = {}
+            if cog and CRS.from_user_input(target_crs) == CRS.from_epsg(3857):
+                transform, width, height, overview_count = zoom_aligned_grid(transform, width, height)
+                # The padding could make the driver add a level the origin isn't aligned for
+                cog_options['OVERVIEW_COUNT'] = overview_count
             kwargs = src.meta.copy()
             kwargs.update({
                 'crs': target_crs,
@@ -24,33 +63,95 @@ def reproject_raster(input_path, output_path, target_crs, nodata_value=None):
                 'height': height,
                 'nodata': nodata_value
             })
+            if cog:
+                # Tiled like the COG so the copy below reads it block by block
+                kwargs.update({'tiled': True, 'blockxsize': tile_size, 'blockysize': tile_size})
+            # Palette indices can't be blended, so indexed charts are resampled nearest and keep their colormap
+            paletted = src.count == 1 and src.colorinterp[0] == rasterio.enums.ColorInterp.palette
+            resampling = Resampling.nearest if paletted else Resampling.bilinear
 
-            with rasterio.open(output_path, 'w', **kwargs) as dst:
-                for i in tqdm(range(1, src.count + 1), desc=f'Reprojecting {os.path.basename(input_path)}', leave=False):
-                    reproject(
-                        source=rasterio.band(src, i),
-                        destination=rasterio.band(dst, i),
-                        src_transform=src.transform,
-                        src_crs=src.crs,
-                        dst_transform=transform,
-                        dst_crs=target_crs,
-                        resampling=Resampling.bilinear,
-                        dst_nodata=nodata_value)
+            with instrument.phase('reproject'), rasterio.open(warp_path, 'w', **kwargs) as dst:
+                if paletted:
+                    dst.write_colormap(1, src.colormap(1))
+                bands = list(range(1, src.count + 1))
+                reproject(
+                    source=rasterio.band(src, bands),
+                    destination=rasterio.band(dst, bands),
+                    src_transform=src.transform,
+                    src_crs=src.crs,
+                    dst_transform=transform,
+                    dst_crs=target_crs,
+                    resampling=resampling,
+                    dst_nodata=nodata_value,
+                    num_threads=num_threads,
+                    warp_mem_limit=warp_mem_mb)
+
+        if cog:
+            with instrument.phase('cog'):
+                rasterio.shutil.copy(
+                    warp_path, output_path, driver='COG',
+                    BLOCKSIZE=tile_size,
+                    COMPRESS='DEFLATE',
+                    PREDICTOR='NO' if paletted else 'YES',
+                    RESAMPLING='NEAREST' if paletted else 'AVERAGE',
+                    NUM_THREADS=num_threads,
+                    **cog_options)
         logging.info(f'Successfully reprojected: {input_path}')
+        return True
     except Exception as e:
         logging.error(f'Error reprojecting {input_path}: {e}')
+        return False
+    finally:
+        if cog and os.path.exists(warp_path):
+            os.remove(warp_path)
+
+# Estimate the peak memory of reprojecting a file from its header. GDAL warps in chunks of at most
+# warp_mem_mb and caches the blocks it reads and writes in its block cache (5% of the physical
+# memory by default); a file smaller than either is held whole.
+def estimate_working_set(input_path, target_crs, options):
+    try:
+        with rasterio.open(input_path) as src:
+            _, width, height = calculate_default_transform(src.crs, target_crs, src.width, src.height, *src.bounds)
+            data_bytes = (src.width * src.height + width * height) * src.count * np.dtype(src.dtypes[0]).itemsize
+    except Exception as e:
+        logging.warning(f'Could not read {input_path} to estimate its memory use, guessing from its size: {e}')
+        return size_estimate(input_path)
+    block_cache = total_memory() // 20 if total_memory() else 256 * 2 ** 20
+    return process_overhead + min(data_bytes, options['warp_mem_mb'] * 2 ** 20) + min(data_bytes, block_cache)
 
+# Returns the input path, whether it was reprojected successfully and its instrumentation record.
+# The output is written under a temporary name and renamed into place once complete.
 def process_file(args):
-    input_path, output_path, target_crs, nodata_value = args
-    reproject_raster(input_path, output_path, target_crs, nodata_value)
+    input_path, output_path, target_crs, nodata_value, options = args
+    instrument.start_item()
+    temp_path = f'{output_path}.{os.getpid()}.tmp'
+    succeeded = reproject_raster(input_path, temp_path, target_crs, nodata_value, **options)
+    if succeeded:
+        os.replace(temp_path, output_path)
+        instrument.count('bytes_written', os.path.getsize(output_path))
+    elif os.path.exists(temp_path):
+        os.remove(temp_path)
+    return input_path, succeeded, instrument.finish_item(os.path.basename(input_path))
 
 def main():
+    # Setup logging
+    logging.basicConfig(filename='reprojecting.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
     # Argument parser setup
     parser = argparse.ArgumentParser(description='Reproject GeoTIFF files to a specified CRS.')
     parser.add_argument('--input_dir', type=str, default='./clipped', help='Input directory containing GeoTIFF files (default: ./clipped)')
     parser.add_argument('--output_dir', type=str, default='./reprojected', help='Output directory for reprojected files (default: ./reprojected)')
     parser.add_argument('--target_crs', type=str, default='EPSG:3857', help='Target CRS for reprojection (default: EPSG:3857)')
     parser.add_argument('--nodata_value', type=int, default=0, help='Nodata value for the output files (default: 0)')
+    parser.add_argument('--force', action='store_true', help='Reproject every file, even if its input is unchanged since the last run')
+    parser.add_argument('--cog', action='store_true', help='Write tiled, compressed Cloud-Optimized GeoTIFFs with overviews aligned to the tile zoom levels')
+    parser.add_argument('--warp_threads', type=int, default=0, help='Threads each file is warped with (default: the CPUs divided among the files being reprojected)')
+    parser.add_argument('--num_processes', type=int, default=cpu_count(), help='Most files reprojected at once (default: number of CPUs)')
+    parser.add_argument('--memory_budget_mb', type=int, default=0, help='Memory the files being reprojected at once may use together, from estimates of each file (default: 75%% of the available memory)')
+    parser.add_argument('--retries', type=int, default=2, help='Times a failed file is retried, each time with half as many processes (default: 2)')
+    parser.add_argument('--warp_mem_mb', type=int, default=512, help='Warp buffer size per file in MB (default: 512)')
+    parser.add_argument('--report', type=str, default=None, help='Time each phase of each file and write a JSON run report to this path, with a CSV of the files next to it')
+    parser.add_argument('--profile_slowest', type=int, default=0, help='With --report, also save cProfile dumps of the N slowest files (default: 0)')
     args = parser.parse_args()
 
     # Ensure output directory exists
@@ -59,20 +160,63 @@ def main():
     # Process each GeoTIFF in the input folder
     tiff_files = [filename for filename in os.listdir(args.input_dir) if filename.endswith('.tif')]
 
-    # Prepare arguments for multiprocessing
-    args_list = [(os.path.join(args.input_dir, filename), os.path.join(args.output_dir, filename), args.target_crs, args.nodata_value) for filename in tiff_files]
+    # The output metadata is the input metadata plus this stage's manifest
+    input_metadata = load_metadata(args.input_dir)
+    if not input_metadata:
+        print("JSON metadata file not found in the input directory.")
+    previous_manifest = stage_manifest(load_metadata(args.output_dir), 'reproject')
+    update_metadata = dict(input_metadata)
+    update_metadata['manifest'] = {key: value for key, value in input_metadata.get('manifest', {}).items() if key == 'extract'}
+    manifest = stage_manifest(update_metadata, 'reproject')
+    # Parameters that change the reprojected output
+    params = {'target_crs': args.target_crs, 'nodata_value': args.nodata_value, 'cog': args.cog}
 
-    # Use multiprocessing to process files concurrently
-    with Pool(cpu_count()) as pool:
-        list(tqdm(pool.imap(process_file, args_list), total=len(args_list), desc='Reprojecting GeoTIFFs'))
+    # Prepare arguments for multiprocessing, skipping files whose input is unchanged
+    args_list = []
+    pending = {}
+    options = {'cog': args.cog, 'warp_mem_mb': args.warp_mem_mb}
+    for filename in tiff_files:
+        input_path = os.path.join(args.input_dir, filename)
+        output_path = os.path.join(args.output_dir, filename)
+        previous_entry = previous_manifest.get(filename, {})
+        inputs = {'raster': file_fingerprint(input_path, previous_entry.get('inputs', {}).get('raster'))}
+        if not args.force and is_up_to_date(previous_entry, inputs, params, output_path):
+            manifest[filename] = previous_entry
+            logging.info(f'Unchanged since the last run, skipping: {input_path}')
+            continue
+        args_list.append((input_path, output_path, args.target_crs, args.nodata_value, options))
+        pending[input_path] = (filename, inputs)
 
-    # Copy JSON file from input directory to output directory
-    json_file = os.path.join(args.input_dir, 'update_metadata.json')
-    if os.path.exists(json_file):
-        shutil.copy(json_file, args.output_dir)
-        print("JSON metadata file copied to the output directory.")
-    else:
-        print("JSON metadata file not found in the input directory.")
+    # Share the CPUs between the files warped at once, unless a thread count was given
+    options['num_threads'] = args.warp_threads or max(1, cpu_count() // max(1, min(args.num_processes, len(args_list))))
+
+    if len(args_list) < len(tiff_files):
+        print(f'{len(tiff_files) - len(args_list)} files unchanged since the last run.')
+    save_metadata(args.output_dir, update_metadata)
+
+    # Reproject the files largest first under the memory budget, recording each file in the manifest as it completes
+    budget = memory_budget(args.memory_budget_mb)
+    jobs = [(os.path.basename(file_args[0]), estimate_working_set(file_args[0], args.target_crs, options), file_args) for file_args in args_list]
+    if jobs:
+        message = f"Reprojecting {len(jobs)} files on up to {args.num_processes} processes, largest estimated at {format_mb(max(job[1] for job in jobs))}, memory budget {format_mb(budget) if budget else 'unlimited'}"
+        logging.info(message)
+        print(message)
+    run_report = RunReport('reproject', args.report, args.num_processes, args.profile_slowest) if args.report else None
+    pool_options = {'initializer': instrument.enable, 'initargs': (args.profile_slowest,)} if run_report else {}
+    scheduled = run_scheduled(process_file, jobs, args.num_processes, budget, lambda result: result[1], args.retries, **pool_options)
+    for file_args, result in tqdm(scheduled, total=len(jobs), desc='Reprojecting GeoTIFFs'):
+        input_path, succeeded, record = result or (file_args[0], False, None)
+        if run_report:
+            run_report.add(record)
+        if succeeded:
+            filename, inputs = pending[input_path]
+            manifest[filename] = {'inputs': inputs, 'params': params}
+            save_metadata(args.output_dir, update_metadata)
+    if run_report:
+        run_report.write()
+
+    if input_metadata:
+        print("JSON metadata file written to the output directory.")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,135 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Memory-aware job scheduler for the per-chart stages. Each job comes with an estimate of its
+# working set; jobs are started largest first, as long as the estimates of the running jobs fit
+# in a memory budget, so a few large charts never run side by side and the longest jobs don't
+# finish last. Failed jobs are retried at the end with half as many processes. A worker killed by
+# the OOM killer halves the processes right away instead, for the jobs still to run and the retries.
+
+# Share of the memory available at the start handed out by default
+default_budget_share = 0.75
+# Memory of a worker process before it reads a chart: the interpreter, numpy, GDAL and geopandas
+process_overhead = 200 * 2 ** 20
+
+# Memory available for new processes in bytes (MemAvailable on Linux), None if it can't be read
+def available_memory():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Physical memory in bytes, None if it can't be read
+def total_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# The memory budget in bytes for a --memory_budget_mb argument: the given size, or by default a
+# share of the available memory (None, meaning no limit, where that can't be read)
+def memory_budget(budget_mb=0):
+    if budget_mb:
+        return budget_mb * 2 ** 20
+    available = available_memory()
+    return int(available * default_budget_share) if available else None
+
+def format_mb(size):
+    return f'{size / 2 ** 20:,.0f} MB'
+
+# Working set of a job guessed from the size of its input file, for when the file can't be opened to
+# estimate it properly. The job will most likely fail and be reported, without stopping the others.
+def size_estimate(path, expansion=4):
+    try:
+        return process_overhead + expansion * os.path.getsize(path)
+    except OSError:
+        return process_overhead
+
+# Run func over jobs, given as (name, estimated bytes, args) tuples, on up to max_workers processes
+# under a memory budget in bytes (None for no limit). A job larger than the whole budget runs alone.
+# succeeded tells from a result whether its job worked; a job that failed, raised or lost its
+# process is run again up to retries times. Yields (args, result) once per job as it finishes for
+# good, with result None if the job never returned one.
+def run_scheduled(func, jobs, max_workers, budget=None, succeeded=bool, retries=2, initializer=None, initargs=()):
+    workers = max(1, max_workers)
+    pending = sorted(jobs, key=lambda job: -job[1])
+    if budget is not None and pending and pending[0][1] > budget:
+        logging.warning(f'{pending[0][0]} needs an estimated {format_mb(pending[0][1])}, more than the {format_mb(budget)} budget; it will run alone')
+    attempt = 0
+    while pending:
+        failed = []
+        # Whether a job failed in this round without its failure already halving the processes
+        failed_in_round = False
+        executor = ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+        running = {}
+        try:
+            while pending or running:
+                # Start the largest jobs that fit next to the running ones
+                in_use = sum(job[1] for job in running.values())
+                for job in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if budget is None or not running or in_use + job[1] <= budget:
+                        pending.remove(job)
+                        running[executor.submit(func, job[2])] = job
+                        in_use += job[1]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job = running.pop(future)
+                    lost = False
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        result = None
+                        lost = broken = True
+                    except Exception as e:
+                        logging.error(f'Error processing {job[0]}: {e}')
+                        result = None
+                    if result is not None and succeeded(result):
+                        yield job[2], result
+                        continue
+                    failed_in_round = failed_in_round or not lost
+                    if attempt < retries:
+                        failed.append(job)
+                    else:
+                        logging.error(f'{job[0]} failed after {attempt + 1} attempts')
+                        yield job[2], result
+
+                if broken:
+                    # A worker died, most likely killed for running out of memory: the jobs running
+                    # with it are lost too, and the rest run on a new pool with half the processes
+                    for future, job in running.items():
+                        future.cancel()
+                        if attempt < retries:
+                            failed.append(job)
+                        else:
+                            yield job[2], None
+                    running.clear()
+                    executor.shutdown(wait=True)
+                    workers = max(1, workers // 2)
+                    logging.warning(f'A worker process died, continuing with {workers} processes')
+                    print(f'A worker process died (out of memory?), continuing with {workers} processes')
+                    executor = ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+        finally:
+            executor.shutdown(wait=True)
+
+        if failed:
+            attempt += 1
+            # Jobs lost with a dead worker already halved the processes when it died
+            if failed_in_round:
+                workers = max(1, workers // 2)
+            names = ', '.join(job[0] for job in failed)
+            logging.warning(f'Retrying {names} with {workers} processes (attempt {attempt + 1} of {retries + 1})')
+            print(f'Retrying {len(failed)} failed jobs with {workers} processes')
+        pending = sorted(failed, key=lambda job: -job[1])
@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import argparse
+import logging
+import numpy as np
+import mercantile
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Pool, cpu_count
+from pmtiles.reader import Reader, MmapSource
+from make_slippy_tile import find_all_geotiffs, build_chart_index, charts_for_tile, init_worker, process_tile, default_options
+from tile_encoders import tile_formats, tile_extension, tile_extensions, data_mime_type
+from tile_sinks import DirectorySink
+
+# Local tile server: answers /{z}/{x}/{y}.png (.webp or .jpg for those tile formats, and either
+# .jpg or .png for jpeg, whose tiles with transparent pixels are PNG), serving
+# prerendered tiles where they exist and rendering the rest on demand with process_tile on a worker
+# pool. Rendered tiles are kept in a memory plus disk LRU cache, and concurrent requests for the
+# same tile share one render.
+
+# Render latencies kept for the p50/p99 report
+latency_window = 10000
+
+# Read-only access to prerendered tiles: a {z}/{x}/{y}.png directory (with the tile format's
+# extensions), an .mbtiles or a .pmtiles file. Returns a function that gets a tile's data, or None if it wasn't prerendered.
+def open_prerendered(path, tile_format='png'):
+    if os.path.isdir(path):
+        return DirectorySink(path, tile_format).read
+
+    if path.endswith('.mbtiles'):
+        # One read-only connection per request thread
+        local = threading.local()
+        def read_tile(tile):
+            if not hasattr(local, 'connection'):
+                local.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            row = local.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                           (tile.z, tile.x, 2 ** tile.z - 1 - tile.y)).fetchone()
+            return row[0] if row else None
+        return read_tile
+
+    if path.endswith('.pmtiles'):
+        archive = open(path, 'rb')
+        reader = Reader(MmapSource(archive))
+        lock = threading.Lock()
+        def read_tile(tile):
+            with lock:
+                return reader.get(tile.z, tile.x, tile.y)
+        return read_tile
+
+    raise ValueError(f'Unknown prerendered tiles: {path}')
+
+# Two-level LRU of encoded tiles with byte budgets. Tiles with nothing on them are cached as b''
+# in memory only, so repeated requests outside the charts don't render again.
+class TileCache:
+    def __init__(self, memory_bytes, disk_bytes=0, cache_dir=None, extension='png'):
+        self.memory_bytes = memory_bytes
+        self.extension = extension
+        self.disk_bytes = disk_bytes if cache_dir else 0
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0}
+
+        # Pick up the disk cache of a previous run, oldest first
+        if self.disk_bytes:
+            cached = []
+            for root, _, files in os.walk(cache_dir):
+                for filename in files:
+                    if filename.endswith('.' + extension):
+                        try:
+                            z, x = os.path.relpath(root, cache_dir).split(os.sep)
+                            tile = mercantile.Tile(int(x), int(filename[:-len(extension) - 1]), int(z))
+                        except ValueError:
+                            # Not a {z}/{x}/{y} cache file
+                            continue
+                        tile_path = os.path.join(root, filename)
+                        cached.append((os.path.getmtime(tile_path), tile, os.path.getsize(tile_path)))
+            for _, tile, size in sorted(cached):
+                self.disk[tile] = size
+                self.disk_size += size
+            self.evict_disk()
+
+    def tile_path(self, tile):
+        return os.path.join(self.cache_dir, str(tile.z), str(tile.x), f'{tile.y}.{self.extension}')
+
+    # The cached data of a tile, b'' for an empty tile, or None on a miss
+    def get(self, tile):
+        with self.lock:
+            if tile in self.memory:
+                self.memory.move_to_end(tile)
+                self.stats['memory_hits'] += 1
+                return self.memory[tile]
+            if tile not in self.disk:
+                return None
+            self.disk.move_to_end(tile)
+        # The file is read without the lock, so another thread may evict it first
+        try:
+            with open(self.tile_path(tile), 'rb') as tile_file:
+                data = tile_file.read()
+        except FileNotFoundError:
+            with self.lock:
+                size = self.disk.pop(tile, None)
+                if size is not None:
+                    self.disk_size -= size
+            return None
+        with self.lock:
+            self.stats['disk_hits'] += 1
+        self.put(tile, data, write_disk=False)
+        return data
+
+    def put(self, tile, data, write_disk=True):
+        with self.lock:
+            if tile in self.memory:
+                self.memory_size -= len(self.memory.pop(tile))
+            self.memory[tile] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_bytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+            write_disk = write_disk and data and self.disk_bytes and tile not in self.disk
+        if not write_disk:
+            return
+
+        # Write the file outside the lock, under a name unique to the thread, then add it to the LRU
+        tile_path = self.tile_path(tile)
+        temp_path = f'{tile_path}.{threading.get_ident()}.tmp'
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        with open(temp_path, 'wb') as tile_file:
+            tile_file.write(data)
+        os.replace(temp_path, tile_path)
+        with self.lock:
+            if tile not in self.disk:
+                self.disk[tile] = len(data)
+                self.disk_size += len(data)
+                self.evict_disk()
+
+    def evict_disk(self):
+        while self.disk_size > self.disk_bytes and self.disk:
+            tile, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            if os.path.exists(self.tile_path(tile)):
+                os.remove(self.tile_path(tile))
+
+# Renders tiles on a worker pool. Requests for a tile that is already being rendered wait for
+# that render instead of starting another.
+class TileRenderer:
+    def __init__(self, chart_index, cache, options, processes):
+        self.chart_index = chart_index
+        self.cache = cache
+        indexed = options['indexed_resampling'] if options['indexed'] else None
+        # Workers run in archive mode, so process_tile sends the encoded tile back instead of writing it
+        encoding = {key: options[key] for key in ('tile_format', 'png_level', 'quality')}
+        self.pool = Pool(processes, initializer=init_worker,
+                         initargs=(options['dataset_cache_size'], options['gdal_cache_mb'], True, indexed, options['cutlines'], None, False, encoding))
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.stats = {'renders': 0, 'coalesced': 0, 'errors': 0}
+
+    def render(self, tile):
+        with self.lock:
+            future = self.in_flight.get(tile)
+            if future is None:
+                future = self.in_flight[tile] = Future()
+                owner = True
+            else:
+                self.stats['coalesced'] += 1
+                owner = False
+        if not owner:
+            return future.result()
+
+        try:
+            geotiff_paths = charts_for_tile(self.chart_index, tile)
+            if not geotiff_paths:
+                # No chart touches the tile, there is nothing to render
+                self.cache.put(tile, b'')
+                self.finish(tile, future, b'')
+                return b''
+
+            started = time.perf_counter()
+            tile_info = (geotiff_paths, tile.z, tile, '')
+
+            def rendered(stats):
+                data = next((data for _, data in stats['tiles']), None) or b''
+                try:
+                    self.cache.put(tile, data)
+                except OSError as e:
+                    logging.error(f'Error caching {tile}: {e}')
+                with self.lock:
+                    self.latencies.append(time.perf_counter() - started)
+                    self.stats['renders'] += 1
+                self.finish(tile, future, data)
+
+            self.pool.apply_async(process_tile, (tile_info,), callback=rendered, error_callback=lambda error: self.fail(tile, future, error))
+        except Exception as e:
+            # Don't leave the requests waiting for this tile hanging
+            if not future.done():
+                self.fail(tile, future, e)
+            raise
+        return future.result()
+
+    # Hand a tile's data to the requests waiting for it
+    def finish(self, tile, future, data):
+        with self.lock:
+            if self.in_flight.get(tile) is future:
+                del self.in_flight[tile]
+        future.set_result(data)
+
+    # Fail the requests waiting for a tile
+    def fail(self, tile, future, error):
+        logging.error(f'Error rendering {tile}: {error}')
+        with self.lock:
+            self.stats['errors'] += 1
+            if self.in_flight.get(tile) is future:
+                del self.in_flight[tile]
+        future.set_exception(error)
+
+    # p50/p99 render latency in milliseconds over the latest renders
+    def latency_report(self):
+        with self.lock:
+            latencies = list(self.latencies)
+        if not latencies:
+            return {'p50_ms': None, 'p99_ms': None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {'p50_ms': round(float(p50), 1), 'p99_ms': round(float(p99), 1)}
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+# Request handler; the cache, renderer and settings are in server.state
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        state = self.server.state
+        if self.path.rstrip('/') == '/stats':
+            self.send_data(200, json.dumps(report(state), indent=4).encode(), 'application/json')
+            return
+
+        tile = parse_tile_path(self.path, state['max_zoom'], state['extensions'])
+        if tile is None:
+            self.send_data(404, b'Not a tile', 'text/plain')
+            return
+
+        data = state['prerendered'](tile) if state['prerendered'] else None
+        if data is not None:
+            with state['cache'].lock:
+                state['stats']['prerendered_hits'] += 1
+        else:
+            data = state['cache'].get(tile)
+            if data is None:
+                try:
+                    data = state['renderer'].render(tile)
+                except Exception:
+                    self.send_data(500, b'Render failed', 'text/plain')
+                    return
+
+        if data:
+            self.send_data(200, data, data_mime_type(data))
+        else:
+            # Nothing on the tile
+            self.send_data(404, b'Empty tile', 'text/plain')
+
+    def send_data(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+# Parse /{z}/{x}/{y}.png (with one of the given extensions) into a tile, or None if it isn't a
+# valid tile path. The tile is served with the type of its data, whichever extension was asked for.
+def parse_tile_path(path, max_zoom, extensions=('png',)):
+    parts = path.split('?')[0].strip('/').split('/')
+    if len(parts) != 3 or '.' not in parts[2] or parts[2].rsplit('.', 1)[1] not in extensions:
+        return None
+    try:
+        z, x, y = int(parts[0]), int(parts[1]), int(parts[2].rsplit('.', 1)[0])
+    except ValueError:
+        return None
+    if not 0 <= z <= max_zoom or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return None
+    return mercantile.Tile(x, y, z)
+
+# Cache, render and latency statistics of the server
+def report(state):
+    return {**state['stats'], **state['cache'].stats, **state['renderer'].stats, **state['renderer'].latency_report(),
+            'memory_cache_mb': round(state['cache'].memory_size / 2 ** 20, 1), 'disk_cache_mb': round(state['cache'].disk_size / 2 ** 20, 1)}
+
+def main():
+    # Setup logging
+    logging.basicConfig(filename='serve.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description='Serve slippy tiles over local HTTP, rendering them from the GeoTIFFs on demand.')
+    parser.add_argument('--input_dir', type=str, default='./reprojected', help='Input directory containing GeoTIFF files (default: ./reprojected)')
+    parser.add_argument('--prerendered', type=str, help='Prerendered tiles to serve first: a tiles directory, or a .mbtiles or .pmtiles file')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--max_zoom', type=int, default=13, help='Highest zoom level rendered (default: 13)')
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='Render worker processes (default: number of CPUs)')
+    parser.add_argument('--memory_cache_mb', type=int, default=256, help='Memory cache budget in MB (default: 256)')
+    parser.add_argument('--disk_cache_mb', type=int, default=0, help='Disk cache budget in MB, 0 to disable (default: 0)')
+    parser.add_argument('--cache_dir', type=str, default='./tile_cache', help='Disk cache directory (default: ./tile_cache)')
+    parser.add_argument('--indexed', action='store_true', help='Render 8-bit palette PNG tiles from paletted charts')
+    parser.add_argument('--tile_format', type=str, default=default_options['tile_format'], choices=list(tile_formats), help=f"Encoding of the rendered tiles, as in make_slippy_tile.py (default: {default_options['tile_format']})")
+    args = parser.parse_args()
+    options = {**default_options, 'indexed': args.indexed, 'tile_format': args.tile_format}
+    extension = tile_extension(args.tile_format)
+
+    # Find all GeoTIFF files in the input directory
+    geotiff_paths = find_all_geotiffs(args.input_dir)
+    if not geotiff_paths:
+        print(f"No GeoTIFF files found in the '{args.input_dir}' directory.")
+        return
+
+    cache = TileCache(args.memory_cache_mb * 2 ** 20, args.disk_cache_mb * 2 ** 20, args.cache_dir, extension)
+    renderer = TileRenderer(build_chart_index(geotiff_paths, keep_palette=args.indexed), cache, options, args.processes)
+    server = ThreadingHTTPServer((args.host, args.port), TileRequestHandler)
+    server.daemon_threads = True
+    server.state = {
+        'cache': cache,
+        'renderer': renderer,
+        'prerendered': open_prerendered(args.prerendered, args.tile_format) if args.prerendered else None,
+        'max_zoom': args.max_zoom,
+        'extensions': tile_extensions(args.tile_format),
+        'stats': {'prerendered_hits': 0},
+    }
+
+    print(f'Serving tiles on http://{args.host}:{args.port}/{{z}}/{{x}}/{{y}}.{extension} (statistics at /stats)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.close()
+        print(json.dumps(report(server.state), indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import io
+import numpy as np
+from PIL import Image
+
+# Tile encoders: turn a rendered tile image into the bytes the sink stores. They only read the
+# image, so make_slippy_tile can run them on its encoder threads while the next tile renders.
+
+# Encoded tile formats and their file extension (also the MBTiles format name)
+tile_formats = {
+    'png': 'png',  # lossless, opaque tiles written as RGB
+    'png8': 'png',  # 8-bit palette, exact up to 255 colours, quantized above
+    'webp': 'webp',  # lossless WebP
+    'webp_lossy': 'webp',
+    'jpeg': 'jpg',  # JPEG for opaque tiles, PNG (as .png) for tiles with transparent pixels; directory sink only
+}
+
+# File extension of a tile format
+def tile_extension(tile_format):
+    return tile_formats[tile_format]
+
+# File extensions the tiles of a format are stored under, the format's own first. The jpeg format
+# writes tiles with transparent pixels as PNG, under a .png name so the name matches the content.
+def tile_extensions(tile_format):
+    return [tile_formats[tile_format], 'png'] if tile_format == 'jpeg' else [tile_formats[tile_format]]
+
+# File extension of a tile's encoded data in a tile format
+def data_extension(data, tile_format):
+    if tile_format == 'jpeg' and data_mime_type(data) == 'image/png':
+        return 'png'
+    return tile_extension(tile_format)
+
+# Whether a tile image is 'empty' (nothing visible), 'opaque' or 'partial'. Reads the extrema of
+# the alpha band, or the transparent index's count in the histogram of a palette image, so no
+# copy of the pixels is made.
+def alpha_coverage(tile_img):
+    if tile_img.mode == 'P':
+        transparent = tile_img.info.get('transparency', 0)
+        transparent_pixels = tile_img.histogram()[transparent]
+        if transparent_pixels == tile_img.width * tile_img.height:
+            return 'empty'
+        return 'opaque' if transparent_pixels == 0 else 'partial'
+    if tile_img.mode != 'RGBA':
+        return 'opaque'
+    low, high = tile_img.getextrema()[3]
+    if high == 0:
+        return 'empty'
+    return 'opaque' if low == 255 else 'partial'
+
+# Convert an RGBA image to a palette image with index 0 transparent (alpha below half).
+# The colours are kept exactly if there are at most 255 of them, otherwise they are quantized.
+def rgba_to_indexed(tile_img):
+    data = np.asarray(tile_img.convert('RGBA'))
+    opaque = data[:, :, 3] >= 128
+    packed = (data[:, :, 0].astype(np.uint32) << 16) | (data[:, :, 1].astype(np.uint32) << 8) | data[:, :, 2]
+    colors, inverse = np.unique(packed[opaque], return_inverse=True)
+
+    indices = np.zeros(opaque.shape, dtype=np.uint8)
+    if len(colors) <= 255:
+        indices[opaque] = inverse + 1
+        palette = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1)
+    else:
+        quantized = Image.fromarray(np.ascontiguousarray(data[:, :, :3]), 'RGB').quantize(255)
+        indices[opaque] = np.asarray(quantized)[opaque] + 1
+        palette = np.array(quantized.getpalette()[:255 * 3]).reshape(-1, 3)
+
+    indexed_img = Image.fromarray(indices, 'P')
+    indexed_img.putpalette(np.vstack([[0, 0, 0], palette]).astype(np.uint8).tobytes())
+    indexed_img.info['transparency'] = 0
+    return indexed_img
+
+# Encode a (non-empty) tile image. png_level is the zlib level of PNG output (0-9), quality the
+# quality of lossy WebP and JPEG (1-100). coverage is the image's alpha_coverage, if known.
+def encode_tile(tile_img, tile_format='png', png_level=6, quality=85, coverage=None):
+    coverage = coverage or alpha_coverage(tile_img)
+    buffer = io.BytesIO()
+    if tile_format == 'png8' and tile_img.mode != 'P':
+        tile_img = rgba_to_indexed(tile_img)
+    if tile_format in ('webp', 'webp_lossy'):
+        if tile_img.mode not in ('RGB', 'RGBA') or (coverage == 'opaque' and tile_img.mode == 'RGBA'):
+            tile_img = tile_img.convert('RGB' if coverage == 'opaque' else 'RGBA')
+        if tile_format == 'webp':
+            tile_img.save(buffer, format='WEBP', lossless=True)
+        else:
+            tile_img.save(buffer, format='WEBP', quality=quality)
+    elif tile_format == 'jpeg' and coverage == 'opaque':
+        tile_img.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    else:
+        # An opaque tile doesn't need its alpha band
+        if tile_img.mode == 'RGBA' and coverage == 'opaque':
+            tile_img = tile_img.convert('RGB')
+        tile_img.save(buffer, format='PNG', compress_level=png_level)
+    return buffer.getvalue()
+
+# MIME type of encoded tile data, from its signature; the tiles of the jpeg format are PNG where
+# they have transparent pixels
+def data_mime_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
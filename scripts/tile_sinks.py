@@ -0,0 +1,315 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import mercantile
+from pmtiles.tile import zxy_to_tileid, tileid_to_zxy, deserialize_header, deserialize_directory, find_tile, TileType, Compression
+from pmtiles.writer import Writer
+from pmtiles.reader import MmapSource, all_tiles
+from tile_encoders import tile_extension, tile_extensions, data_extension
+
+# Tile sinks: where make_slippy_tile puts the encoded tiles. The directory sink is written to
+# by the workers themselves; the archive sinks are written to by the parent process only, fed
+# with the encoded tiles the workers send back. Tile readers read a sink's output without ever
+# writing to it.
+
+sink_kinds = ['dir', 'mbtiles', 'pmtiles']
+
+# PMTiles tile type of each tile file extension. The jpeg format mixes JPEG and PNG tiles, which
+# an archive's single tile type can't describe, so it is only written to directories.
+pmtiles_types = {'png': TileType.PNG, 'webp': TileType.WEBP}
+
+# Open the sink of the given kind in the tiles directory, for tiles in the given tile format
+def open_sink(kind, tiles_dir, tile_format='png'):
+    if kind == 'dir':
+        return DirectorySink(tiles_dir, tile_format)
+    if kind == 'mbtiles':
+        return MBTilesSink(os.path.join(tiles_dir, 'tiles.mbtiles'), tile_format)
+    if kind == 'pmtiles':
+        return PMTilesSink(os.path.join(tiles_dir, 'tiles.pmtiles'), tile_format)
+    raise ValueError(f'Unknown tile sink: {kind}')
+
+# Open a read-only reader of the tiles a sink of the given kind wrote to the tiles directory. A
+# directory sink never writes when it is only read from, so it serves as its own reader.
+def open_reader(kind, tiles_dir, tile_format='png'):
+    if kind == 'dir':
+        return DirectorySink(tiles_dir, tile_format)
+    if kind == 'mbtiles':
+        return MBTilesReader(os.path.join(tiles_dir, 'tiles.mbtiles'))
+    if kind == 'pmtiles':
+        return PMTilesReader(os.path.join(tiles_dir, 'tiles.pmtiles'))
+    raise ValueError(f'Unknown tile sink: {kind}')
+
+# Write a file under a temporary name and rename it into place, so readers and resumed runs never
+# see a partly written file. The temporary name is unique to the writing process.
+def write_atomic(path, data):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+# Content hash used to store identical tiles once
+def tile_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# The {z}/{x}/{y}.png layout (.webp or .jpg for those formats). A jpeg tile with transparent pixels
+# is PNG and goes under .png, so a tile of the jpeg format can be under either name.
+class DirectorySink:
+    workers_write = True
+
+    def __init__(self, tiles_dir, tile_format='png'):
+        self.tiles_dir = tiles_dir
+        self.extension = tile_extension(tile_format)
+        self.extensions = tile_extensions(tile_format)
+        self.tile_format = tile_format
+
+    def tile_path(self, tile, extension=None):
+        return os.path.join(self.tiles_dir, str(tile.z), str(tile.x), f'{tile.y}.{extension or self.extension}')
+
+    # The tile's file under whichever name it was written, or None
+    def existing_path(self, tile):
+        for extension in self.extensions:
+            if os.path.exists(self.tile_path(tile, extension)):
+                return self.tile_path(tile, extension)
+        return None
+
+    def write(self, tile, data):
+        extension = data_extension(data, self.tile_format)
+        tile_path = self.tile_path(tile, extension)
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        write_atomic(tile_path, data)
+        # Drop the tile's previous file if it was written under the other name
+        for other in self.extensions:
+            if other != extension and os.path.exists(self.tile_path(tile, other)):
+                os.remove(self.tile_path(tile, other))
+
+    def delete(self, tile):
+        for extension in self.extensions:
+            if os.path.exists(self.tile_path(tile, extension)):
+                os.remove(self.tile_path(tile, extension))
+
+    def read(self, tile):
+        tile_path = self.existing_path(tile)
+        if tile_path is None:
+            return None
+        with open(tile_path, 'rb') as tile_file:
+            return tile_file.read()
+
+    # True if the tile was written after the given time, used to resume interrupted runs
+    def written_since(self, tile, started):
+        tile_path = self.existing_path(tile)
+        return tile_path is not None and os.path.getmtime(tile_path) >= started
+
+    def close(self, bounds=None, zoom_levels=None):
+        pass
+
+# MBTiles (SQLite) with the deduplicated map/images schema. Writes are batched into transactions.
+# The map table also records when each tile was written, so an interrupted run can resume.
+class MBTilesSink:
+    workers_write = False
+
+    def __init__(self, path, tile_format='png', batch_size=1000):
+        self.path = path
+        self.extension = tile_extension(tile_format)
+        self.batch_size = batch_size
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT, UNIQUE (name));
+            CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT, written REAL,
+                                            PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        ''')
+        # Archives written before the column was added
+        if 'written' not in [column[1] for column in self.connection.execute('PRAGMA table_info(map)')]:
+            self.connection.execute('ALTER TABLE map ADD COLUMN written REAL')
+
+    # MBTiles rows are numbered from the south (TMS)
+    def key(self, tile):
+        return tile.z, tile.x, 2 ** tile.z - 1 - tile.y
+
+    def write(self, tile, data):
+        tile_id = tile_hash(data)
+        self.connection.execute('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)', (tile_id, data))
+        self.connection.execute('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id, written) VALUES (?, ?, ?, ?, ?)',
+                                (*self.key(tile), tile_id, time.time()))
+        self.count_write()
+
+    def delete(self, tile):
+        self.connection.execute('DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', self.key(tile))
+        self.count_write()
+
+    def count_write(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.connection.commit()
+            self.pending = 0
+
+    def read(self, tile):
+        row = self.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', self.key(tile)).fetchone()
+        return row[0] if row else None
+
+    # True if the tile was written after the given time. Tiles in the batches committed before a run
+    # was interrupted count; those of the last, uncommitted batch are rendered again.
+    def written_since(self, tile, started):
+        row = self.connection.execute('SELECT written FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', self.key(tile)).fetchone()
+        return row is not None and row[0] is not None and row[0] >= started
+
+    def close(self, bounds=None, zoom_levels=None):
+        # Drop images no longer referenced by any tile, then record the metadata
+        self.connection.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+        metadata = {'name': 'Sectional charts', 'format': self.extension, 'type': 'overlay'}
+        zooms = self.connection.execute('SELECT MIN(zoom_level), MAX(zoom_level) FROM map').fetchone()
+        if zooms[0] is not None:
+            metadata.update({'minzoom': str(zooms[0]), 'maxzoom': str(zooms[1])})
+        if bounds:
+            metadata['bounds'] = ','.join(str(value) for value in bounds)
+        self.connection.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', metadata.items())
+        self.connection.commit()
+        self.connection.close()
+
+# PMTiles v3. PMTiles can't be updated in place, so tiles are collected in a deduplicated
+# temporary store (seeded from the existing archive, if any) and the archive is rewritten on close.
+class PMTilesSink:
+    workers_write = False
+
+    def __init__(self, path, tile_format='png'):
+        self.path = path
+        self.extension = tile_extension(tile_format)
+        self.data_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.data_offset = 0
+        self.offsets = {}  # tile hash -> (offset, length) in the data file
+        self.entries = {}  # tile id -> tile hash
+        self.modified = False
+        if os.path.exists(path):
+            with open(path, 'rb') as archive:
+                for (z, x, y), data in all_tiles(MmapSource(archive)):
+                    self.write(mercantile.Tile(x, y, z), data)
+        self.modified = False
+
+    def write(self, tile, data):
+        hsh = tile_hash(data)
+        if hsh not in self.offsets:
+            self.data_file.seek(self.data_offset)
+            self.data_file.write(data)
+            self.offsets[hsh] = (self.data_offset, len(data))
+            self.data_offset += len(data)
+        self.entries[zxy_to_tileid(tile.z, tile.x, tile.y)] = hsh
+        self.modified = True
+
+    def delete(self, tile):
+        if self.entries.pop(zxy_to_tileid(tile.z, tile.x, tile.y), None) is not None:
+            self.modified = True
+
+    def read(self, tile):
+        hsh = self.entries.get(zxy_to_tileid(tile.z, tile.x, tile.y))
+        if hsh is None:
+            return None
+        offset, length = self.offsets[hsh]
+        self.data_file.seek(offset)
+        return self.data_file.read(length)
+
+    # The archive is only written on close, so an interrupted run leaves nothing to resume from and
+    # the next run renders the interrupted zoom levels again
+    def written_since(self, tile, started):
+        return False
+
+    def close(self, bounds=None, zoom_levels=None):
+        # Leave the archive alone if nothing changed
+        if not self.modified:
+            self.data_file.close()
+            return
+        if not self.entries:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.data_file.close()
+            return
+        west, south, east, north = bounds or (-180, -85, 180, 85)
+        tile_ids = sorted(self.entries)
+        min_zoom, max_zoom = tileid_to_zxy(tile_ids[0])[0], tileid_to_zxy(tile_ids[-1])[0]
+        header = {
+            'tile_type': pmtiles_types[self.extension],
+            'tile_compression': Compression.NONE,
+            'min_lon_e7': int(west * 10000000),
+            'min_lat_e7': int(south * 10000000),
+            'max_lon_e7': int(east * 10000000),
+            'max_lat_e7': int(north * 10000000),
+            'center_zoom': min_zoom,
+            'center_lon_e7': int((west + east) / 2 * 10000000),
+            'center_lat_e7': int((south + north) / 2 * 10000000),
+        }
+        metadata = {'name': 'Sectional charts', 'type': 'overlay', 'minzoom': min_zoom, 'maxzoom': max_zoom}
+
+        # Write to a temporary file first so a failure never leaves a truncated archive
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as archive:
+            writer = Writer(archive)
+            for tile_id in tile_ids:
+                offset, length = self.offsets[self.entries[tile_id]]
+                self.data_file.seek(offset)
+                writer.write_tile(tile_id, self.data_file.read(length))
+            writer.finalize(header, metadata)
+        os.replace(tmp_path, self.path)
+        self.data_file.close()
+
+# Reads an MBTiles archive through a read-only connection, so the archive is never modified. A
+# missing archive reads as empty, like a missing directory.
+class MBTilesReader:
+    def __init__(self, path):
+        self.connection = None
+        if os.path.exists(path):
+            # A cleanly closed archive has no write-ahead log; opened immutable, SQLite doesn't create
+            # one (or its shared memory file) next to it either
+            immutable = '&immutable=1' if not os.path.exists(f'{path}-wal') else ''
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro{immutable}', uri=True)
+
+    def read(self, tile):
+        if self.connection is None:
+            return None
+        row = self.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                      (tile.z, tile.x, 2 ** tile.z - 1 - tile.y)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+# Reads tiles straight from a PMTiles archive. Deserialized directories are kept, so each lookup
+# is a binary search instead of decompressing the root directory again. A missing archive reads
+# as empty.
+class PMTilesReader:
+    def __init__(self, path):
+        self.archive = open(path, 'rb') if os.path.exists(path) else None
+        self.source = MmapSource(self.archive) if self.archive else None
+        self.header = deserialize_header(self.source(0, 127)) if self.archive else None
+        self.directories = {}
+
+    def directory(self, offset, length):
+        if (offset, length) not in self.directories:
+            self.directories[(offset, length)] = deserialize_directory(self.source(offset, length))
+        return self.directories[(offset, length)]
+
+    def read(self, tile):
+        if self.archive is None:
+            return None
+        tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
+        offset, length = self.header['root_offset'], self.header['root_length']
+        # The spec allows leaf directories three levels deep
+        for _ in range(4):
+            entry = find_tile(self.directory(offset, length), tile_id)
+            if entry is None:
+                return None
+            if entry.run_length > 0:
+                return self.source(self.header['tile_data_offset'] + entry.offset, entry.length)
+            offset, length = self.header['leaf_directory_offset'] + entry.offset, entry.length
+        return None
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()